@@ -1,2 +1,3 @@
 from .empiar_data_curation import *
-from .cryosparc_data_process import *
\ No newline at end of file
+from .cryosparc_data_process import *
+from .full_diff_h5_generation import *
\ No newline at end of file
@@ -5,6 +5,8 @@ from tqdm import tqdm
 import pandas as pd
 import logging
 from pathlib import Path
+from bson import json_util
+from pymongo import UpdateOne
 from pymongo.collection import Collection
 logger = logging.getLogger()
 
@@ -38,4 +40,51 @@ def update_dataset_col_with_docID_key_value(dataset: Collection, docID: str, key
     """
     Update the dataset collection with the docID key value
     """
-    dataset.update_one({"_id": docID}, {"$set": {key: value}})
\ No newline at end of file
+    dataset.update_one({"_id": docID}, {"$set": {key: value}})
+
+def backfill_dataset_col(
+    dataset: Collection,
+    compute_fn,
+    projection: dict,
+    query: dict = None,
+    batch_size: int = 1000,
+    checkpoint_path: str = None,
+    resume: bool = False,
+    desc: str = "Backfill",
+):
+    """
+    Backfill derived fields: compute_fn(doc) returns the {key: value} to set on each document (empty to skip),
+    only the projected fields are read and the updates are sent in unordered bulk writes of batch_size.
+    The _id of the last written batch is kept in checkpoint_path, so a run with resume continues after it.
+    """
+    query = dict(query or {})
+    checkpoint_path = Path(checkpoint_path) if checkpoint_path is not None else None
+    if resume and checkpoint_path is not None and checkpoint_path.exists():
+        last_id = json_util.loads(checkpoint_path.read_text())["last_id"]
+        query = {"$and": [query, {"_id": {"$gt": last_id}}]}
+        logger.info(f"{PROJECT_NAME} resume backfill after _id {last_id}")
+
+    def flush(update_ops: list, last_id):
+        if len(update_ops) > 0:
+            dataset.bulk_write(update_ops, ordered=False)
+        if checkpoint_path is not None:
+            checkpoint_path.parent.mkdir(parents=True, exist_ok=True)
+            checkpoint_path.write_text(json_util.dumps({"last_id": last_id}))
+
+    # sorted by _id, so everything before the checkpointed _id is done
+    cursor = dataset.find(query, projection, batch_size=batch_size).sort("_id", 1)
+    update_ops, last_id, updated_num = [], None, 0
+    for doc in tqdm(cursor, desc, total=dataset.count_documents(query)):
+        values = compute_fn(doc)
+        if values:
+            update_ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": values}))
+        last_id = doc["_id"]
+        if len(update_ops) >= batch_size:
+            flush(update_ops, last_id)
+            updated_num += len(update_ops)
+            update_ops = []
+    if last_id is not None:
+        flush(update_ops, last_id)
+        updated_num += len(update_ops)
+    logger.info(f"{PROJECT_NAME} backfill {updated_num} documents of {dataset.name}")
+    return updated_num
@@ -15,33 +15,22 @@ PROJECT_SAVE_DIR = get_project_save_dir()
 
 from ...utils.datatype import DeterminationMethod
 from ...utils.mongodb import get_spa_micrograph_dataset, get_empiar_dataset
+from ...utils.dataset_stats import get_image_and_gain_suffix_counts
 from ...utils.datatype import SingleImageTestStatus, CryoCRAB_DataManager, CryoCRAB_Download_DataType, DownloadMode
 
-from .helper_func import get_ftp_download_path, update_dataset_SingleImageTestStatus, unset_dataset_SingleImageTestStatus, update_dataset_col_with_docID_key_value
+from .helper_func import get_ftp_download_path, update_dataset_SingleImageTestStatus, unset_dataset_SingleImageTestStatus, update_dataset_col_with_docID_key_value, backfill_dataset_col
 
 def preview_all_suffixes_in_spa_empiar_dataset(apply_image_max_num_filter=False):
     """
     Preview all suffixes in the SPA EMPIAR dataset
     """
     empiar_dataset = get_empiar_dataset()
-    document = empiar_dataset.find({"determination_method": DeterminationMethod.spa})
-    image_suffix_list = []
-    gain_suffix_list = []
-    for doc in tqdm(document, "Preview image/gain suffix"):
-        if apply_image_max_num_filter:
-            image_suffix_list+=[os.path.splitext(image_path)[1] for image_path in doc["empiar_image_relative_paths"]]
-            gain_suffix_list+=[os.path.splitext(gain_path)[1] for gain_path in doc["empiar_gain_relative_paths"]]
-        else:
-            if doc["image_num"] > 0:
-                image_suffix_list += [os.path.splitext(doc["empiar_image_relative_paths"][0])[1]] * doc["image_num"]
-            if doc["gain_num"] > 0:
-                gain_suffix_list += [os.path.splitext(doc["empiar_gain_relative_paths"][0])[1]] * doc["gain_num"]
-    image_suffix_count_dict = dict()
-    for suffix in set(image_suffix_list):
-        image_suffix_count_dict[suffix] = image_suffix_list.count(suffix)
-    gain_suffix_count_dict = dict()
-    for suffix in set(gain_suffix_list):
-        gain_suffix_count_dict[suffix] = gain_suffix_list.count(suffix)
+    # counted by the server, only the suffix counts are transferred
+    image_suffix_count_dict, gain_suffix_count_dict = get_image_and_gain_suffix_counts(
+        empiar_dataset,
+        apply_image_max_num_filter=apply_image_max_num_filter,
+        query={"determination_method": DeterminationMethod.spa},
+    )
     # plot histograms
     fig, ax = plt.subplots(2, 1, figsize=(10, 10))
     ax[0].bar(image_suffix_count_dict.keys(), image_suffix_count_dict.values())
@@ -52,15 +41,29 @@ def preview_all_suffixes_in_spa_empiar_dataset(apply_image_max_num_filter=False)
     plt.show()
     return image_suffix_count_dict, gain_suffix_count_dict
 
-def update_empiar_dataset_image_and_gain_suffix():
-    
+def get_image_and_gain_suffix(doc: dict):
+    """
+    Get the image / gain suffix of a dataset document from its first paths
+    """
+    values = dict()
+    if doc["image_num"] > 0:
+        values["image_suffix"] = os.path.splitext(doc["empiar_image_relative_paths"][0])[1]
+    if doc["gain_num"] > 0:
+        values["gain_suffix"] = os.path.splitext(doc["empiar_gain_relative_paths"][0])[1]
+    return values
+
+def update_empiar_dataset_image_and_gain_suffix(batch_size: int=1000, resume: bool=False):
+    """
+    Update the image / gain suffix of all the EMPIAR dataset documents, in batched bulk writes
+    """
     empiar_dataset = get_empiar_dataset()
-    document = empiar_dataset.find()
-    for doc in tqdm(document, "Update image/gain suffix"):
-        if doc["image_num"] > 0:
-            image_suffix = os.path.splitext(doc["empiar_image_relative_paths"][0])[1]
-            update_dataset_col_with_docID_key_value(empiar_dataset, doc["_id"], "image_suffix", image_suffix)
-        if doc["gain_num"] > 0:
-            gain_suffix = os.path.splitext(doc["empiar_gain_relative_paths"][0])[1]
-            update_dataset_col_with_docID_key_value(empiar_dataset, doc["_id"], "gain_suffix", gain_suffix)
-            
\ No newline at end of file
+    return backfill_dataset_col(
+        empiar_dataset,
+        get_image_and_gain_suffix,
+        # only the first path is needed
+        projection={"image_num": 1, "gain_num": 1, "empiar_image_relative_paths": {"$slice": 1}, "empiar_gain_relative_paths": {"$slice": 1}},
+        batch_size=batch_size,
+        checkpoint_path=Path(PROJECT_SAVE_DIR) / "Data" / "checkpoints" / "empiar_dataset_suffix_backfill.json",
+        resume=resume,
+        desc="Update image/gain suffix",
+    )
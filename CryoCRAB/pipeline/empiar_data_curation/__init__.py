@@ -2,13 +2,17 @@
 from .step0_empiar_ids import get_empiar_ids, save_empiar_ids, load_empiar_ids
 
 # Get the empiar file structure
-from .step1_empiar_structure import load_empiar_structure, save_empiar_structures
+from .step1_empiar_structure import load_empiar_structure, save_empiar_structures, crawl_empiar_path_catalog
 
-# Get the empiar path csv
-from .step2_empiar_path_csv import load_empiar_path_csv, save_empiar_path_csvs
+# Get the empiar path csv / path catalog
+from .step2_empiar_path_csv import load_empiar_path_csv, save_empiar_path_csvs, save_empiar_path_catalog, load_empiar_relative_paths, get_empiar_relative_paths
+from .empiar_path_catalog import EMPIAR_Path_Catalog, get_empiar_path_catalog
 
 # Crawl empiar / emdb entries
 from .step3_crawl_empiar_emdb_entries import save_empiar_emdb_entries, get_empiar_emdb_pair_list, parse_empiar_emdb_pair
 
 # Generate cryocrab dataset document
-from .step4_generate_dataset_document import generate_empiar_dataset_documents, generate_micrograph_dataset_documents, generate_movie_dataset_documents
\ No newline at end of file
+from .step4_generate_dataset_document import generate_dataset_documents, generate_empiar_dataset_documents, generate_micrograph_dataset_documents, generate_movie_dataset_documents
+
+# Update the dataset image / gain dimensions from the headers of the downloaded files
+from .step5_update_dataset_dimensions import update_dataset_dimensions
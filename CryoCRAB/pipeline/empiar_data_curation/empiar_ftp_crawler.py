@@ -0,0 +1,201 @@
+import time
+import queue
+import ftplib
+import logging
+import calendar
+import threading
+import posixpath
+from tqdm import tqdm
+logger = logging.getLogger()
+
+from CryoCRAB.utils import EMPIAR, get_project_name
+PROJECT_NAME = get_project_name()
+
+from .helper_func import new_ftp, process_item_list
+from .empiar_path_catalog import EMPIAR_Path_Catalog, normalize_empiar_id
+
+# ----------------------------------------------------- EMPIAR FTP CRAWLER
+# Crawling is bound by the round trip of each listing, not by bandwidth, so num_connections persistent
+# connections list directories of all the entries concurrently from one shared queue. MLSD gives the
+# type / size / mtime of a whole directory in one command without cwd, servers without it fall back to cwd + LIST.
+# Listings are streamed into the path catalog by the calling thread, the only SQLite writer.
+
+MLSD_UNSUPPORTED_CODES = ["500", "501", "502", "504"]
+
+def parse_mlsd_modify(modify: str):
+    """
+    MLSD modify fact (UTC, YYYYMMDDHHMMSS[.sss]) -> unix timestamp, None if missing or malformed
+    """
+    try:
+        seconds, _, fraction = modify.partition(".")
+        timestamp = calendar.timegm(time.strptime(seconds, "%Y%m%d%H%M%S"))
+        return timestamp + (float("0." + fraction) if fraction else 0.0)
+    except (AttributeError, ValueError):
+        return None
+
+def parse_list_size(item: str):
+    """
+    Size column of a unix LIST line, None if not parsable
+    """
+    parts = item.split()
+    return int(parts[4]) if len(parts) > 4 and parts[4].isdigit() else None
+
+def mlsd_directory(ftp: ftplib.FTP, path: str):
+    """
+    List a directory with MLSD, [(name, "file" / "directory", size, mtime)]
+    """
+    items = []
+    for name, facts in ftp.mlsd(path):
+        item_type = facts.get("type", "file").lower()
+        if item_type in ["cdir", "pdir"] or name in [".", ".."]:
+            continue
+        if item_type == "dir":
+            items.append((name, "directory", None, None))
+        else:
+            size = facts.get("size", None)
+            items.append((name, "file", int(size) if size is not None and size.isdigit() else None, parse_mlsd_modify(facts.get("modify", None))))
+    return items
+
+def list_directory_with_sizes(ftp: ftplib.FTP, path: str):
+    """
+    List a directory with cwd + LIST, [(name, "file" / "directory", size, None)]
+    """
+    ftp.cwd(path)
+    lines = []
+    ftp.retrlines("LIST", lines.append)
+    items = []
+    for line in lines:
+        name, item_type = process_item_list(line)
+        if name in [".", ".."]:
+            continue
+        items.append((name, item_type, parse_list_size(line) if item_type == "file" else None, None))
+    return items
+
+class EMPIAR_FTP_Crawler:
+    """
+    Concurrent crawler of EMPIAR entries into the path catalog over num_connections persistent FTP connections
+    """
+    def __init__(self, num_connections: int=8, retries: int=3, retry_backoff: float=2.0, use_mlsd: bool=True, connect_fn=new_ftp):
+        self.num_connections = num_connections
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.use_mlsd = use_mlsd # switched off for all connections once the server rejects MLSD
+        self.connect_fn = connect_fn
+        self.tasks = queue.Queue()
+        self.results = queue.Queue()
+
+    def list_directory(self, ftp: ftplib.FTP, path: str):
+        if self.use_mlsd:
+            try:
+                return mlsd_directory(ftp, path)
+            except ftplib.error_perm as e:
+                if str(e)[:3] not in MLSD_UNSUPPORTED_CODES:
+                    raise
+                logger.info(f"{PROJECT_NAME} FTP server does not support MLSD ({e}), fall back to LIST")
+                self.use_mlsd = False
+        return list_directory_with_sizes(ftp, path)
+
+    def close_connection(self, ftp: ftplib.FTP):
+        try:
+            if ftp is not None:
+                ftp.close()
+        except ftplib.all_errors:
+            pass
+
+    def worker(self):
+        ftp = None
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+            empiar_id, relative_dir = task
+            path = posixpath.join(EMPIAR().DIRECTORY, empiar_id.replace("EMPIAR-", ""), relative_dir)
+            items, subdirs, error = None, [], None
+            try:
+                for attempt in range(self.retries + 1):
+                    try:
+                        if ftp is None:
+                            ftp = self.connect_fn()
+                        items = self.list_directory(ftp, path)
+                        break
+                    except ftplib.error_perm as e:
+                        error = e # e.g. 550, the directory is gone, not worth retrying
+                        break
+                    except ftplib.all_errors as e:
+                        error = e
+                        # the connection is dropped and reopened, the server may have closed it
+                        self.close_connection(ftp)
+                        ftp = None
+                        if attempt < self.retries:
+                            time.sleep(self.retry_backoff * 2 ** attempt)
+                if items is not None:
+                    subdirs = [posixpath.join(relative_dir, name) for name, item_type, _, _ in items if item_type == "directory"]
+            except Exception as e:
+                # e.g. a listing that can not be decoded or parsed, the connection may be left mid-transfer
+                items, subdirs, error = None, [], e
+                self.close_connection(ftp)
+                ftp = None
+            finally:
+                # always reported, so the entry is marked failed and crawl never waits for it
+                # the result goes before the subdirectories, so the parent counts them before any of them is reported
+                self.results.put((empiar_id, relative_dir, items, len(subdirs), None if items is not None else error))
+            for subdir in subdirs:
+                self.tasks.put((empiar_id, subdir))
+        if ftp is not None:
+            try:
+                ftp.quit()
+            except ftplib.all_errors:
+                ftp.close()
+
+    def crawl(self, empiar_ids: list[str], catalog: EMPIAR_Path_Catalog):
+        """
+        Crawl the EMPIAR entries into the catalog, an entry is marked complete only if all its directories were listed.
+        Return the number of paths of each complete entry.
+        """
+        empiar_ids = [normalize_empiar_id(empiar_id) for empiar_id in empiar_ids]
+        if len(empiar_ids) == 0:
+            return {}
+        pending = {}
+        failed = set()
+        for empiar_id in empiar_ids:
+            catalog.delete_empiar_paths(empiar_id)
+            pending[empiar_id] = 1
+            self.tasks.put((empiar_id, ""))
+        threads = [threading.Thread(target=self.worker, daemon=True) for _ in range(self.num_connections)]
+        for thread in threads:
+            thread.start()
+
+        path_nums = {}
+        tqdm_bar = tqdm(total=len(empiar_ids), desc="Crawl EMPIAR paths")
+        try:
+            while len(pending) > 0:
+                empiar_id, relative_dir, items, subdir_num, error = self.results.get()
+                if error is not None:
+                    failed.add(empiar_id)
+                    logger.warning(f"Failed to list {empiar_id}/{relative_dir}: {error}")
+                elif empiar_id not in failed:
+                    files = [(posixpath.join(relative_dir, name), size, mtime) for name, item_type, size, mtime in items if item_type == "file"]
+                    if len(files) > 0:
+                        relative_paths, sizes, mtimes = zip(*files)
+                        catalog.insert_paths(empiar_id, list(relative_paths), list(sizes), list(mtimes))
+                pending[empiar_id] += subdir_num - 1
+                if pending[empiar_id] == 0:
+                    pending.pop(empiar_id)
+                    if empiar_id not in failed:
+                        path_nums[empiar_id] = catalog.finish_empiar(empiar_id)
+                    tqdm_bar.update(1)
+        finally:
+            tqdm_bar.close()
+            # drain what is left if the loop was interrupted, then stop the workers
+            while True:
+                try:
+                    self.tasks.get_nowait()
+                except queue.Empty:
+                    break
+            for _ in threads:
+                self.tasks.put(None)
+            for thread in threads:
+                thread.join()
+        if len(failed) > 0:
+            logger.warning(f"{PROJECT_NAME} {len(failed)} EMPIAR entries were not crawled completely, rerun to crawl them again")
+        return path_nums
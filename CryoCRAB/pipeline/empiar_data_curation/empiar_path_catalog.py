@@ -0,0 +1,189 @@
+import os
+import time
+import sqlite3
+import logging
+import pandas as pd
+from pathlib import Path
+from typing import Union
+logger = logging.getLogger()
+
+from CryoCRAB.utils import get_project_name, get_project_save_dir
+PROJECT_NAME = get_project_name()
+PROJECT_SAVE_DIR = get_project_save_dir()
+
+EMPIAR_PATH_CATALOG_FILE = Path(PROJECT_SAVE_DIR) / "Data" / "empiar-paths" / "empiar_path_catalog.sqlite"
+
+# ----------------------------------------------------- EMPIAR PATH CATALOG
+# All the EMPIAR file paths in one SQLite file, one row per file with its directory, lower case extension,
+# size and mtime (NULL if unknown). The (empiar_id, relative_path) primary key serves the directory prefix
+# lookups as range scans, the extension index the data format lookups, so an imageset query only reads its own rows.
+
+EMPIAR_PATH_CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS empiar_path (
+    empiar_id TEXT NOT NULL,
+    relative_path TEXT NOT NULL,
+    directory TEXT NOT NULL,
+    ext TEXT NOT NULL,
+    size INTEGER,
+    mtime REAL,
+    PRIMARY KEY (empiar_id, relative_path)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS empiar_path_directory ON empiar_path (empiar_id, directory);
+CREATE INDEX IF NOT EXISTS empiar_path_ext ON empiar_path (empiar_id, ext);
+CREATE TABLE IF NOT EXISTS empiar_entry (
+    empiar_id TEXT PRIMARY KEY,
+    path_num INTEGER NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+EMPIAR_PATH_COLUMNS = ["relative_path", "directory", "ext", "size", "mtime"]
+
+def normalize_empiar_id(empiar_id: str):
+    """
+    10001 / "10001" / "EMPIAR-10001" -> "EMPIAR-10001"
+    """
+    empiar_id = str(empiar_id)
+    return empiar_id if empiar_id.startswith("EMPIAR-") else "EMPIAR-{}".format(empiar_id)
+
+def get_path_ext(path: str):
+    """
+    Lower case last extension of a path, "" if none, e.g. "a/b.TIF.bz2" -> ".bz2"
+    """
+    name = path.rsplit("/", 1)[-1]
+    return "." + name.rsplit(".", 1)[1].lower() if "." in name else ""
+
+def get_prefix_upper_bound(prefix: str):
+    # every string starting with prefix sorts in [prefix, prefix + max code point)
+    return prefix + "\U0010ffff"
+
+def filter_relative_paths(paths: pd.Series, prefix: str="", exts: list[str]=None) -> pd.Series:
+    """
+    Keep the paths starting with prefix and ending with one of exts (case insensitive), vectorized
+    """
+    mask = pd.Series(True, index=paths.index)
+    if prefix != "":
+        mask &= paths.str.startswith(prefix)
+    if exts is not None:
+        mask &= paths.str.lower().str.endswith(tuple(ext.lower() for ext in exts))
+    return paths[mask]
+
+class EMPIAR_Path_Catalog:
+    """
+    SQLite catalog of the EMPIAR file paths
+    """
+    def __init__(self, path: Union[str, Path]=None, readonly: bool=False):
+        self.path = Path(EMPIAR_PATH_CATALOG_FILE if path is None else path)
+        self.readonly = readonly
+        if readonly:
+            self.conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, timeout=60)
+        else:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.conn = sqlite3.connect(self.path, timeout=60)
+            # WAL lets the document generation workers read while a crawl writes
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.executescript(EMPIAR_PATH_CATALOG_SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def insert_paths(self, empiar_id: str, relative_paths: list[str], sizes: list[int]=None, mtimes: list[float]=None):
+        """
+        Insert or replace the paths of an EMPIAR entry, sizes / mtimes are optional
+        """
+        empiar_id = normalize_empiar_id(empiar_id)
+        sizes = [None] * len(relative_paths) if sizes is None else sizes
+        mtimes = [None] * len(relative_paths) if mtimes is None else mtimes
+        rows = (
+            (empiar_id, relative_path, relative_path.rsplit("/", 1)[0] if "/" in relative_path else "", get_path_ext(relative_path), size, mtime)
+            for relative_path, size, mtime in zip(relative_paths, sizes, mtimes)
+        )
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO empiar_path VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    def delete_empiar_paths(self, empiar_id: str):
+        """
+        Delete all the paths of an EMPIAR entry
+        """
+        empiar_id = normalize_empiar_id(empiar_id)
+        with self.conn:
+            self.conn.execute("DELETE FROM empiar_path WHERE empiar_id = ?", (empiar_id,))
+            self.conn.execute("DELETE FROM empiar_entry WHERE empiar_id = ?", (empiar_id,))
+
+    def finish_empiar(self, empiar_id: str):
+        """
+        Mark an EMPIAR entry as complete, its paths are used from now on
+        """
+        empiar_id = normalize_empiar_id(empiar_id)
+        with self.conn:
+            path_num = self.conn.execute("SELECT COUNT(*) FROM empiar_path WHERE empiar_id = ?", (empiar_id,)).fetchone()[0]
+            self.conn.execute("INSERT OR REPLACE INTO empiar_entry VALUES (?, ?, ?)", (empiar_id, path_num, time.time()))
+        return path_num
+
+    def replace_empiar_paths(self, empiar_id: str, relative_paths: list[str], sizes: list[int]=None, mtimes: list[float]=None):
+        """
+        Replace all the paths of an EMPIAR entry and mark it as complete
+        """
+        self.delete_empiar_paths(empiar_id)
+        self.insert_paths(empiar_id, relative_paths, sizes, mtimes)
+        return self.finish_empiar(empiar_id)
+
+    def has_empiar_id(self, empiar_id: str):
+        return self.get_entry_info(empiar_id) is not None
+
+    def get_entry_info(self, empiar_id: str):
+        """
+        (path_num, updated_at) of a complete EMPIAR entry, None if it is not in the catalog
+        """
+        row = self.conn.execute("SELECT path_num, updated_at FROM empiar_entry WHERE empiar_id = ?", (normalize_empiar_id(empiar_id),)).fetchone()
+        return None if row is None else tuple(row)
+
+    def get_empiar_ids(self) -> list[str]:
+        return [row[0] for row in self.conn.execute("SELECT empiar_id FROM empiar_entry ORDER BY empiar_id")]
+
+    def query_paths(self, empiar_id: str, prefix: str="", exts: list[str]=None, columns: list[str]=None) -> pd.DataFrame:
+        """
+        Get the paths of an EMPIAR entry starting with prefix and ending with one of exts (case insensitive),
+        sorted by relative path. The prefix is a string prefix like str.startswith, not only a directory.
+        """
+        columns = ["relative_path"] if columns is None else columns
+        unknown_columns = [column for column in columns if column not in EMPIAR_PATH_COLUMNS]
+        if len(unknown_columns) > 0:
+            raise ValueError(f"Unknown catalog columns {unknown_columns}, expected {EMPIAR_PATH_COLUMNS}")
+        query_columns = columns if "relative_path" in columns else ["relative_path"] + columns
+        sql = f"SELECT {', '.join(query_columns)} FROM empiar_path WHERE empiar_id = ?"
+        params = [normalize_empiar_id(empiar_id)]
+        if prefix != "":
+            sql += " AND relative_path >= ? AND relative_path < ?"
+            params += [prefix, get_prefix_upper_bound(prefix)]
+        if exts is not None and len(exts) > 0 and all("." in ext for ext in exts):
+            # the index narrows to the last extension, the full (e.g. ".tif.bz2") match is done below
+            last_exts = sorted(set(get_path_ext(ext) for ext in exts))
+            sql += f" AND ext IN ({', '.join('?' * len(last_exts))})"
+            params += last_exts
+        sql += " ORDER BY relative_path"
+        table = pd.read_sql_query(sql, self.conn, params=params)
+        if exts is not None:
+            table = table.loc[filter_relative_paths(table["relative_path"], exts=exts).index].reset_index(drop=True)
+        return table[columns]
+
+# one read-only connection per process, connections can not be shared across fork
+EMPIAR_PATH_CATALOGS = {}
+
+def get_empiar_path_catalog(path: Union[str, Path]=None) -> EMPIAR_Path_Catalog:
+    """
+    Get the read-only path catalog of this process, None if the catalog does not exist yet
+    """
+    path = Path(EMPIAR_PATH_CATALOG_FILE if path is None else path)
+    if not path.exists():
+        return None
+    key = (os.getpid(), str(path))
+    if key not in EMPIAR_PATH_CATALOGS:
+        EMPIAR_PATH_CATALOGS[key] = EMPIAR_Path_Catalog(path, readonly=True)
+    return EMPIAR_PATH_CATALOGS[key]
@@ -6,6 +6,8 @@ from ftplib import FTP
 from pathlib import Path
 from CryoCRAB.utils import EMPIAR
 import requests
+import pandas as pd
+from typing import Union
 
 logging.basicConfig(level=logging.WARNING)
 logger = logging.getLogger(__name__)
@@ -220,39 +222,39 @@ def filter_paths(paths: list[str], ban_list: list):
     filtered_paths = [rel_path for rel_path in paths if all(ban.lower() not in rel_path.lower() for ban in ban_list)]
     return filtered_paths
 
+def get_ban_mask(lower_paths: pd.Series, ban_list: list):
+    """
+    Vectorized filter_paths, True for the (lower case) paths without any ban word
+    """
+    mask = pd.Series(True, index=lower_paths.index)
+    for ban in ban_list:
+        mask &= ~lower_paths.str.contains(ban.lower(), regex=False)
+    return mask
 
-def get_image_paths_of_empiar_imageset(data_format: str, dataset_name: str, data_directory: str, rel_paths: list[str]):
+def get_image_paths_of_empiar_imageset(data_format: str, dataset_name: str, data_directory: str, rel_paths: Union[list[str], pd.Series]):
     possible_ext = data_format_to_possible_ext(dataset_name, data_format)
-    def path_match(path:str, dir:str, exts:list[str]):
-        """
-        Check if the path matches the directory and extensions
-        """
-        path_str = str(path)
-        dir_match = path_str.startswith(dir)
-        ext_match = any([path_str.lower().endswith(ext) for ext in exts])
-        return dir_match and ext_match
-    rel_paths = [path for path in rel_paths if path_match(path, data_directory, possible_ext)]
+    # the paths are matched as whole columns, entries have up to millions of files
+    rel_paths = pd.Series(rel_paths, dtype=object)
+    lower_paths = rel_paths.str.lower()
+    mask = rel_paths.str.startswith(data_directory) & lower_paths.str.endswith(tuple(possible_ext))
     image_paths_ban_words = image_paths_ban_words_patch(dataset_name, ["particles"])
-    rel_paths = sorted(filter_paths(rel_paths, image_paths_ban_words))
+    mask &= get_ban_mask(lower_paths, image_paths_ban_words)
     if not data_directory.endswith("/"): 
         data_directory = data_directory + "/"
-    rel_paths = [path[len(data_directory):] for path in rel_paths]
-    return rel_paths
+    return [path[len(data_directory):] for path in sorted(rel_paths[mask].tolist())]
+
+GAIN_PATH_PARTS = ["superref", "gain", "norm", "reference", "countref"]
+GAIN_PATH_EXTS = [".dm4", ".gain", ".mrc"]
 
-def get_gain_paths_of_empiar_imageset(rel_paths: list[str]):
-    def path_match(path: str, parts: list[str], exts: list[str]):
-        """
-        Check if the path matches the parts and extensions
-        """
-        path_str = str(path).lower()
-        part_match = any(part in path_str for part in parts)
-        ext_match = any([path_str.endswith(ext) for ext in exts])
-        return part_match and ext_match
-    parts = ["superref", "gain", "norm", "reference", "countref"]
-    possible_ext = [".dm4", ".gain", ".mrc"]
-    rel_paths = [path for path in rel_paths if path_match(path, parts, possible_ext)]
-    rel_paths = sorted(filter_paths(rel_paths, ["defects", "dark"]))
-    return rel_paths
+def get_gain_paths_of_empiar_imageset(rel_paths: Union[list[str], pd.Series]):
+    rel_paths = pd.Series(rel_paths, dtype=object)
+    lower_paths = rel_paths.str.lower()
+    mask = lower_paths.str.endswith(tuple(GAIN_PATH_EXTS))
+    part_mask = pd.Series(False, index=rel_paths.index)
+    for part in GAIN_PATH_PARTS:
+        part_mask |= lower_paths.str.contains(part, regex=False)
+    mask &= part_mask & get_ban_mask(lower_paths, ["defects", "dark"])
+    return sorted(rel_paths[mask].tolist())
 
 def is_none(v):
     return v is None or (type(v) == str and v == "")
@@ -13,6 +13,8 @@ PROJECT_SAVE_DIR = get_project_save_dir()
 
 from .step0_empiar_ids import load_empiar_ids
 from .helper_func import get_empiar_structure
+from .empiar_path_catalog import EMPIAR_PATH_CATALOG_FILE, EMPIAR_Path_Catalog
+from .empiar_ftp_crawler import EMPIAR_FTP_Crawler
 
 EMPIAR_STRUCTURE_DIR = Path(PROJECT_SAVE_DIR) / "Data" / "empiar-paths" / "empiar_structure"
 EMPIAR_STRUCTURE_FILE = lambda empiar_id: EMPIAR_STRUCTURE_DIR / "{}.json".format(empiar_id.replace("EMPIAR-", ""))
@@ -43,14 +45,57 @@ def load_empiar_structure(empiar_id: str):
     logger.debug(f"{PROJECT_NAME} load EMPIAR structure for {empiar_id} from {EMPIAR_STRUCTURE_FILE(empiar_id)}")
     return empiar_structure
 
-def save_empiar_structures():
+def relative_paths_to_structure(relative_paths: list[str]):
     """
-    Save the EMPIAR structure for each EMPIAR ID to a json file
+    Relative paths -> EMPIAR structure like mirror_directory, files first then directories, both sorted by name
+    """
+    tree = {}
+    for relative_path in relative_paths:
+        node = tree
+        *dirs, name = relative_path.split("/")
+        for dir in dirs:
+            node = node.setdefault(dir, {})
+        node[name] = None
+    def to_structure(node: dict):
+        files = sorted(name for name, child in node.items() if child is None)
+        dirs = sorted(name for name, child in node.items() if child is not None)
+        return files + [{dir: to_structure(node[dir])} for dir in dirs]
+    return to_structure(tree)
+
+def crawl_empiar_path_catalog(empiar_ids: list[str]=None, num_connections: int=8, overwrite: bool=False):
+    """
+    Crawl the paths (with size / mtime) of the EMPIAR entries into the path catalog over num_connections concurrent FTP connections,
+    entries already in the catalog are skipped unless overwrite
+    """
+    if empiar_ids is None:
+        empiar_ids = load_empiar_ids()
+    with EMPIAR_Path_Catalog() as catalog:
+        todo_empiar_ids = [empiar_id for empiar_id in empiar_ids if overwrite or not catalog.has_empiar_id(empiar_id)]
+        logger.info(f"{PROJECT_NAME} crawl {len(todo_empiar_ids)} EMPIAR entries, skip {len(empiar_ids) - len(todo_empiar_ids)} in the catalog")
+        path_nums = EMPIAR_FTP_Crawler(num_connections=num_connections).crawl(todo_empiar_ids, catalog)
+    logger.info(f"{PROJECT_NAME} save {sum(path_nums.values())} paths of {len(path_nums)} EMPIAR entries to {EMPIAR_PATH_CATALOG_FILE}")
+    return path_nums
+
+def save_empiar_structures(num_connections: int=8):
+    """
+    Save the EMPIAR structure for each EMPIAR ID to a json file,
+    the missing entries are crawled concurrently into the path catalog first
     """
     empiar_ids = load_empiar_ids()
     logger.debug(f"{PROJECT_NAME} FTP {len(empiar_ids)} EMPIAR IDs")
-    for empiar_id in tqdm(empiar_ids, "Crawl EMPIAR structures"):
-        if not EMPIAR_STRUCTURE_FILE(empiar_id).exists():
+    todo_empiar_ids = [empiar_id for empiar_id in empiar_ids if not EMPIAR_STRUCTURE_FILE(empiar_id).exists()]
+    crawl_empiar_path_catalog(todo_empiar_ids, num_connections=num_connections)
+    EMPIAR_STRUCTURE_DIR.mkdir(parents=True, exist_ok=True)
+    with EMPIAR_Path_Catalog() as catalog:
+        for empiar_id in tqdm(todo_empiar_ids, "Save EMPIAR structures"):
+            if not catalog.has_empiar_id(empiar_id):
+                logger.error(f"Failed to get EMPIAR structure for {empiar_id}")
+                continue
+            relative_paths = catalog.query_paths(empiar_id)["relative_path"].tolist()
+            if len(relative_paths) == 0:
+                logger.error(f"Failed to get EMPIAR structure for {empiar_id}")
+                continue
             logger.debug(f"{empiar_id} -> {EMPIAR_STRUCTURE_FILE(empiar_id)}")
-            save_empiar_structure(empiar_id)
-    logger.info(f"{PROJECT_NAME} save {len(empiar_ids)} EMPIAR IDs to {EMPIAR_STRUCTURE_DIR}")
\ No newline at end of file
+            with open(EMPIAR_STRUCTURE_FILE(empiar_id), "w") as f:
+                json.dump(relative_paths_to_structure(relative_paths), f, indent=4)
+    logger.info(f"{PROJECT_NAME} save {len(empiar_ids)} EMPIAR IDs to {EMPIAR_STRUCTURE_DIR}")
@@ -14,6 +14,7 @@ PROJECT_SAVE_DIR = get_project_save_dir()
 from .step0_empiar_ids import load_empiar_ids
 from .step1_empiar_structure import load_empiar_structure
 from .helper_func import generate_relative_paths, get_absolute_ftp_path
+from .empiar_path_catalog import EMPIAR_PATH_CATALOG_FILE, EMPIAR_Path_Catalog, get_empiar_path_catalog, filter_relative_paths
 
 EMPIAR_PATH_CSV_DIR = Path(PROJECT_SAVE_DIR) / "Data" / "empiar-paths" / "empiar_path_csv" 
 EMPIAR_PATH_CSV_FILE = lambda empiar_id: EMPIAR_PATH_CSV_DIR / "{}.csv".format(empiar_id.replace("EMPIAR-", ""))
@@ -50,4 +51,42 @@ def save_empiar_path_csvs():
         if not EMPIAR_PATH_CSV_FILE(empiar_id).exists():
             save_empiar_path_csv(empiar_id)
     logger.info(f"{PROJECT_NAME} save {len(empiar_ids)} EMPIAR path csvs to {EMPIAR_PATH_CSV_DIR}")
-    
\ No newline at end of file
+    
+
+def save_empiar_path_catalog(empiar_ids: list[str]=None, overwrite: bool=False):
+    """
+    Save the paths of the EMPIAR structures into the path catalog, entries already in the catalog are kept unless overwrite
+    """
+    if empiar_ids is None:
+        empiar_ids = load_empiar_ids()
+    path_num = 0
+    with EMPIAR_Path_Catalog() as catalog:
+        for empiar_id in tqdm(empiar_ids, "Saving EMPIAR path catalog"):
+            if not overwrite and catalog.has_empiar_id(empiar_id):
+                continue
+            relative_paths = generate_relative_paths(load_empiar_structure(empiar_id))
+            path_num += catalog.replace_empiar_paths(empiar_id, relative_paths)
+    logger.info(f"{PROJECT_NAME} save {path_num} EMPIAR paths to {EMPIAR_PATH_CATALOG_FILE}")
+    return path_num
+
+def load_empiar_relative_paths(empiar_id: str) -> pd.Series:
+    """
+    Load all the sorted relative paths of an EMPIAR entry from the EMPIAR path csv, to be filtered by
+    get_empiar_relative_paths for each imageset. None if the entry is in the path catalog, which is queried instead.
+    """
+    catalog = get_empiar_path_catalog()
+    if catalog is not None and catalog.has_empiar_id(empiar_id):
+        return None
+    return load_empiar_path_csv(empiar_id)["relative_path"].astype(str).sort_values().reset_index(drop=True)
+
+def get_empiar_relative_paths(empiar_id: str, prefix: str="", exts: list[str]=None, relative_paths: pd.Series=None) -> pd.Series:
+    """
+    Get the relative paths of an EMPIAR entry starting with prefix and ending with one of exts,
+    filtered from relative_paths if given (see load_empiar_relative_paths), otherwise from the path catalog
+    if the entry is in it, otherwise from the EMPIAR path csv
+    """
+    if relative_paths is None:
+        relative_paths = load_empiar_relative_paths(empiar_id)
+        if relative_paths is None:
+            return get_empiar_path_catalog().query_paths(empiar_id, prefix=prefix, exts=exts)["relative_path"]
+    return filter_relative_paths(relative_paths, prefix=prefix, exts=exts).reset_index(drop=True)
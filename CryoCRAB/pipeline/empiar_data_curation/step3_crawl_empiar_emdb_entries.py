@@ -13,8 +13,8 @@ PROJECT_NAME = get_project_name()
 PROJECT_SAVE_DIR = get_project_save_dir()
 
 from .step0_empiar_ids import load_empiar_ids
-from .step2_empiar_path_csv import load_empiar_path_csv
-from .helper_func import  get_response, read_list_safely, read_dict_safely, read_element_safely, get_image_paths_of_empiar_imageset, get_gain_paths_of_empiar_imageset, is_none, str_default, int_default, float_default
+from .step2_empiar_path_csv import load_empiar_relative_paths, get_empiar_relative_paths
+from .helper_func import  get_response, read_list_safely, read_dict_safely, read_element_safely, get_image_paths_of_empiar_imageset, get_gain_paths_of_empiar_imageset, data_format_to_possible_ext, GAIN_PATH_EXTS, is_none, str_default, int_default, float_default
 from .empiar_patch import empiar_id_patch, data_format_patch
 
 EMPIAR_ENTRY_DIR = Path(PROJECT_SAVE_DIR) / "Data" / "empiar-emdb-entries" / "empiar_entry"
@@ -110,7 +110,6 @@ def parse_empiar_emdb_pair(pair_dict: dict, image_max_num=1000) -> list[DatasetD
     imagesets_doc_list = []
     empiar_id = pair_dict["empiar"]["name"]
     empiar_number = empiar_id.replace("EMPIAR-", "")
-    empiar_path_csv = load_empiar_path_csv(empiar_id)
     empiar_entry = load_empiar_entry(empiar_id)
     emdb_entries = [load_emdb_entry_with_path(emdb["json_path"]) for emdb in pair_dict["emdb"]]
     imagesets_list:list[dict] = read_list_safely(empiar_entry, "imagesets")
@@ -170,6 +169,10 @@ def parse_empiar_emdb_pair(pair_dict: dict, image_max_num=1000) -> list[DatasetD
     paper_doi = read_element_safely(read_list_safely(empiar_entry, "citation", [""])[0], "doi")
     
     empiar_ftp_directory = "ftp.ebi.ac.uk/empiar/world_availability/{}".format(empiar_number)
+    # entries not in the catalog read their csv once here, not once per imageset
+    empiar_relative_paths = load_empiar_relative_paths(empiar_id)
+    # the gain paths are the same for all the imagesets of an entry
+    all_empiar_gain_relative_paths = get_gain_paths_of_empiar_imageset(get_empiar_relative_paths(empiar_id, exts=GAIN_PATH_EXTS, relative_paths=empiar_relative_paths))
     for imageset_idx, imageset_c in enumerate(imagesets_list):
         imageset_name = "{}-imageset-{:02d}".format(dataset_name, imageset_idx)
         imageset_title = imageset_c.get("name", "")
@@ -184,8 +187,12 @@ def parse_empiar_emdb_pair(pair_dict: dict, image_max_num=1000) -> list[DatasetD
         pixel_type = imageset_c.get("voxel_type", PixelType.Other.value)
         empiar_relative_directory = imageset_c.get("directory", "") 
         # image / gain
-        empiar_image_relative_paths = get_image_paths_of_empiar_imageset(image_type, dataset_name, empiar_relative_directory, empiar_path_csv["relative_path"].tolist())
-        empiar_gain_relative_paths = get_gain_paths_of_empiar_imageset(empiar_path_csv["relative_path"].tolist())
+        # only the paths under the imageset directory with its data format extensions are read from the catalog
+        candidate_relative_paths = get_empiar_relative_paths(
+            empiar_id, prefix=empiar_relative_directory, exts=data_format_to_possible_ext(dataset_name, image_type), relative_paths=empiar_relative_paths,
+        )
+        empiar_image_relative_paths = get_image_paths_of_empiar_imageset(image_type, dataset_name, empiar_relative_directory, candidate_relative_paths)
+        empiar_gain_relative_paths = all_empiar_gain_relative_paths
         image_num = len(empiar_image_relative_paths)
         gain_num = len(empiar_gain_relative_paths)
         
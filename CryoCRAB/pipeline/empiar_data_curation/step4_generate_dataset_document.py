@@ -2,6 +2,7 @@ import os
 import datetime
 import logging
 import json
+import hashlib
 from tqdm import tqdm
 import pandas as pd
 import logging
@@ -11,68 +12,137 @@ logger = logging.getLogger()
 
 from CryoCRAB.utils import get_project_name, get_project_save_dir
 from CryoCRAB.utils.datatype import *
-from CryoCRAB.utils.parallel import start_work_ppe
+from CryoCRAB.utils.parallel import iter_work_ppe, TaskCheckpoint, TaskError
 
 PROJECT_NAME = get_project_name()
 PROJECT_SAVE_DIR = get_project_save_dir()
+DATASET_DOCUMENTS_CHECKPOINT_FILE = lambda collection_name: Path(PROJECT_SAVE_DIR) / "Data" / "checkpoints" / f"{collection_name}_documents.txt"
 
+from .step2_empiar_path_csv import EMPIAR_PATH_CSV_FILE
+from .empiar_path_catalog import get_empiar_path_catalog
 from .step3_crawl_empiar_emdb_entries import get_empiar_emdb_pair_list, parse_empiar_emdb_pair
-from CryoCRAB.utils.mongodb import get_empiar_dataset, update_dataset_col_with_docs, get_spa_micrograph_dataset, get_spa_movie_dataset, micrograph_dataset_filter, movie_dataset_filter
+from CryoCRAB.utils.mongodb import get_dataset, update_dataset_col_with_docs, micrograph_dataset_filter, movie_dataset_filter
 
-def generate_empiar_dataset_documents_workfn(pair_dict: dict, image_max_num: int=1000):
+# target collection -> document filter, None keeps all the documents
+DATASET_DOCUMENT_FILTERS = {
+    "empiar_dataset": None,
+    "micrograph_dataset": micrograph_dataset_filter,
+    "movie_dataset": movie_dataset_filter,
+}
+
+def get_pair_name(pair_dict: dict):
+    return pair_dict["empiar"]["name"]
+
+def get_pair_source_files(pair_dict: dict) -> list[Path]:
+    """
+    Get the source files parse_empiar_emdb_pair reads for a pair
     """
-    Generate the EMPIAR dataset documents
+    empiar_id = get_pair_name(pair_dict)
+    return [Path(pair_dict["empiar"]["json_path"]), EMPIAR_PATH_CSV_FILE(empiar_id)] + [Path(emdb["json_path"]) for emdb in pair_dict["emdb"]]
+
+def get_pair_fingerprint(pair_dict: dict, image_max_num: int=1000) -> str:
+    """
+    Fingerprint of the source files (path, size, mtime) and path catalog entry of a pair, only the files are stat-ed, not read
     """
-    col = get_empiar_dataset()
-    imagesets_doc_list:list[DatasetDocument] = parse_empiar_emdb_pair(pair_dict,image_max_num=image_max_num)
-    update_dataset_col_with_docs(col, imagesets_doc_list)
-    logger.debug(f"Generated {len(imagesets_doc_list)} dataset documents for {pair_dict['empiar']['name']}")
-    return len(imagesets_doc_list)
-    
-def generate_empiar_dataset_documents(num_workers: int=10, image_max_num: int=1000):
+    catalog = get_empiar_path_catalog()
+    catalog_info = None if catalog is None else catalog.get_entry_info(get_pair_name(pair_dict))
+    file_stats = []
+    for path in get_pair_source_files(pair_dict):
+        try:
+            stat = path.stat()
+            file_stats.append([str(path), stat.st_size, stat.st_mtime_ns])
+        except FileNotFoundError:
+            file_stats.append([str(path), None, None])
+    return hashlib.sha1(json.dumps([image_max_num, catalog_info, file_stats]).encode()).hexdigest()[:16]
+
+def get_pair_checkpoint_key(pair_dict: dict, fingerprint: str):
+    return f"{get_pair_name(pair_dict)}:{fingerprint}"
+
+def generate_dataset_documents_workfn(item: dict, image_max_num: int=1000):
     """
-    Generate the EMPIAR dataset documents
+    Parse an EMPIAR-EMDB pair once and write its documents to each target collection in one bulk write
     """
-    get_empiar_dataset() # try create to avoid error
-    empiar_emdb_pair_list = get_empiar_emdb_pair_list()
-    start_work_ppe(generate_empiar_dataset_documents_workfn, empiar_emdb_pair_list, show_tqdm=True, num_workers=num_workers, image_max_num=image_max_num)
-    
-def generate_micrograph_dataset_documents_workfn(pair_dict: dict, image_max_num: int=1000):
+    pair_dict = item["pair"]
+    imagesets_doc_list:list[DatasetDocument] = parse_empiar_emdb_pair(pair_dict, image_max_num=image_max_num)
+    doc_nums = {}
+    for collection_name in item["collection_names"]:
+        dataset_filter = DATASET_DOCUMENT_FILTERS[collection_name]
+        docs = [doc for doc in imagesets_doc_list if dataset_filter is None or dataset_filter(doc.determination_method, doc.image_category)]
+        if len(docs) > 0:
+            # the client is shared by the process, see mongodb.get_mongo_client
+            update_dataset_col_with_docs(get_dataset(collection_name), docs)
+        doc_nums[collection_name] = len(docs)
+    logger.debug(f"Generated {doc_nums} dataset documents for {get_pair_name(pair_dict)}")
+    return doc_nums
+
+def generate_dataset_documents(collection_names: list[str]=None, num_workers: int=10, image_max_num: int=1000, force: bool=False, timeout: float=1800):
     """
-    Generate the micrograph dataset documents
+    Generate the dataset documents of several collections (all of DATASET_DOCUMENT_FILTERS by default) in one pass,
+    each EMPIAR-EMDB pair is parsed once and its documents are routed to the collections through their filters.
+    A pair is skipped for a collection if its source files did not change since it was last written there,
+    force regenerates all the pairs. A failing or hung pair (timeout seconds) is retried twice and then logged,
+    it is not checkpointed so the next run retries it.
     """
-    col = get_spa_micrograph_dataset()
-    imagesets_doc_list:list[DatasetDocument] = parse_empiar_emdb_pair(pair_dict,image_max_num=image_max_num)
-    imagesets_doc_list = [doc for doc in imagesets_doc_list if micrograph_dataset_filter(doc.determination_method, doc.image_category)]
-    if len(imagesets_doc_list) > 0:
-        update_dataset_col_with_docs(col, imagesets_doc_list)
-    logger.debug(f"Generated {len(imagesets_doc_list)} dataset documents for {pair_dict['empiar']['name']}")
-    return len(imagesets_doc_list)
-    
-def generate_micrograph_dataset_documents(num_workers: int=10, image_max_num: int=1000):
+    if collection_names is None:
+        collection_names = list(DATASET_DOCUMENT_FILTERS)
+    elif type(collection_names) is not list:
+        collection_names = [collection_names]
+    unknown_names = [name for name in collection_names if name not in DATASET_DOCUMENT_FILTERS]
+    if len(unknown_names) > 0:
+        raise ValueError(f"Unknown dataset collections {unknown_names}, expected {list(DATASET_DOCUMENT_FILTERS)}")
+    for collection_name in collection_names:
+        get_dataset(collection_name) # try create to avoid error
+    checkpoints = {name: TaskCheckpoint(DATASET_DOCUMENTS_CHECKPOINT_FILE(name), resume=not force) for name in collection_names}
+
+    items = []
+    skip_num = 0
+    for pair_dict in get_empiar_emdb_pair_list():
+        fingerprint = get_pair_fingerprint(pair_dict, image_max_num)
+        key = get_pair_checkpoint_key(pair_dict, fingerprint)
+        todo_names = [name for name in collection_names if key not in checkpoints[name]]
+        if len(todo_names) == 0:
+            skip_num += 1
+            continue
+        items.append({"pair": pair_dict, "fingerprint": fingerprint, "collection_names": todo_names})
+    if skip_num > 0:
+        logger.info(f"{PROJECT_NAME} skip {skip_num} unchanged EMPIAR entries")
+
+    doc_nums = {name: 0 for name in collection_names}
+    error_num = 0
+    for index, result in iter_work_ppe(
+        generate_dataset_documents_workfn, items, show_tqdm=True, num_workers=num_workers,
+        timeout=timeout, retries=2, capture_errors=True, image_max_num=image_max_num,
+    ):
+        if isinstance(result, TaskError):
+            error_num += 1
+            logger.warning(f"Failed to generate dataset documents for {get_pair_name(items[index]['pair'])} ({result.error_type}: {result.error})")
+            continue
+        key = get_pair_checkpoint_key(items[index]["pair"], items[index]["fingerprint"])
+        for collection_name, doc_num in result.items():
+            doc_nums[collection_name] += doc_num
+            checkpoints[collection_name].add(key)
+    for checkpoint in checkpoints.values():
+        checkpoint.close()
+    if error_num > 0:
+        logger.warning(f"{PROJECT_NAME} {error_num} EMPIAR entries failed, rerun to retry only them")
+    for collection_name, doc_num in doc_nums.items():
+        logger.info(f"{PROJECT_NAME} generate {doc_num} {collection_name} documents")
+    return doc_nums
+
+def generate_empiar_dataset_documents(num_workers: int=10, image_max_num: int=1000, force: bool=False):
     """
-    Generate the micrograph dataset documents
+    Generate the EMPIAR dataset documents, see generate_dataset_documents
     """
-    get_spa_micrograph_dataset() # try create to avoid error
-    empiar_emdb_pair_list = get_empiar_emdb_pair_list()
-    start_work_ppe(generate_micrograph_dataset_documents_workfn, empiar_emdb_pair_list, show_tqdm=True, num_workers=num_workers, image_max_num=image_max_num)
-    
-def generate_movie_dataset_documents_workfn(pair_dict: dict, image_max_num: int=1000):
+    return generate_dataset_documents(["empiar_dataset"], num_workers=num_workers, image_max_num=image_max_num, force=force)["empiar_dataset"]
+
+def generate_micrograph_dataset_documents(num_workers: int=10, image_max_num: int=1000, force: bool=False):
     """
-    Generate the movie dataset documents
+    Generate the micrograph dataset documents, see generate_dataset_documents
     """
-    col = get_spa_movie_dataset()
-    imagesets_doc_list:list[DatasetDocument] = parse_empiar_emdb_pair(pair_dict,image_max_num=image_max_num)
-    imagesets_doc_list = [doc for doc in imagesets_doc_list if movie_dataset_filter(doc.determination_method, doc.image_category)]
-    if len(imagesets_doc_list) > 0:
-        update_dataset_col_with_docs(col, imagesets_doc_list)
-    logger.debug(f"Generated {len(imagesets_doc_list)} dataset documents for {pair_dict['empiar']['name']}")
-    return len(imagesets_doc_list)
+    return generate_dataset_documents(["micrograph_dataset"], num_workers=num_workers, image_max_num=image_max_num, force=force)["micrograph_dataset"]
 
-def generate_movie_dataset_documents(num_workers: int=10, image_max_num: int=1000):
+def generate_movie_dataset_documents(num_workers: int=10, image_max_num: int=1000, force: bool=False):
     """
-    Generate the movie dataset documents
+    Generate the movie dataset documents, see generate_dataset_documents
     """
-    get_spa_movie_dataset() # try create to avoid error
-    empiar_emdb_pair_list = get_empiar_emdb_pair_list()
-    start_work_ppe(generate_movie_dataset_documents_workfn, empiar_emdb_pair_list, show_tqdm=True, num_workers=num_workers, image_max_num=image_max_num)
+    return generate_dataset_documents(["movie_dataset"], num_workers=num_workers, image_max_num=image_max_num, force=force)["movie_dataset"]
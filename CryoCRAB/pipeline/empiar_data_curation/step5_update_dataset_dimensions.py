@@ -0,0 +1,72 @@
+import logging
+from collections import Counter
+logger = logging.getLogger()
+
+from CryoCRAB.utils import get_project_name
+from CryoCRAB.utils.datatype import *
+from CryoCRAB.utils.parallel import start_work_ppe
+from CryoCRAB.utils.image_header import IMAGE_HEADER_READERS, ImageHeader, read_image_header
+from CryoCRAB.utils.mongodb import get_dataset, update_dataset_col_with_values
+
+PROJECT_NAME = get_project_name()
+
+def get_local_image_dir(imageset_name: str, download_datatype: CryoCRAB_Download_DataType):
+    """
+    Get the local directory of the downloaded images of an imageset
+    """
+    return CryoCRAB_DataManager().ftppath_to_localpath(imageset_name, "placeholder", download_datatype).parent
+
+def scan_local_image_headers(imageset_name: str, download_datatype: CryoCRAB_Download_DataType, image_scan_num: int=16) -> list[ImageHeader]:
+    """
+    Read the headers of the first image_scan_num downloaded images of an imageset
+    """
+    local_dir = get_local_image_dir(imageset_name, download_datatype)
+    if not local_dir.exists():
+        return []
+    filepaths = sorted(path for path in local_dir.iterdir() if path.is_file() and path.suffix.lower() in IMAGE_HEADER_READERS)
+    headers = [read_image_header(filepath) for filepath in filepaths[:image_scan_num]]
+    return [header for header in headers if header is not None]
+
+def get_common_shape(imageset_name: str, headers: list[ImageHeader]):
+    """
+    Get the most common (width, height) of the headers, warn if the images have different shapes
+    """
+    shape_counter = Counter((header.width, header.height) for header in headers)
+    if len(shape_counter) > 1:
+        logger.warning(f"{imageset_name} images have different shapes {dict(shape_counter)}")
+    return shape_counter.most_common(1)[0][0]
+
+def update_dataset_dimensions_workfn(doc: dict, image_scan_num: int=16):
+    """
+    Get the image / gain dimensions of an imageset from the headers of its downloaded files
+    """
+    imageset_name = doc["imageset_name"]
+    values = {}
+    image_headers = []
+    for download_datatype in [CryoCRAB_Download_DataType.micrograph, CryoCRAB_Download_DataType.movie]:
+        image_headers += scan_local_image_headers(imageset_name, download_datatype, image_scan_num)
+    if len(image_headers) > 0:
+        image_width, image_height = get_common_shape(imageset_name, image_headers)
+        # EMPIAR may store the dimensions as None
+        empiar_shape = (doc.get("image_width") or 0, doc.get("image_height") or 0)
+        if min(empiar_shape) > 0 and empiar_shape != (image_width, image_height):
+            logger.warning(f"{imageset_name} image shape {(image_width, image_height)} differs from EMPIAR {empiar_shape}")
+        values["image_width"], values["image_height"] = image_width, image_height
+
+    gain_headers = scan_local_image_headers(imageset_name, CryoCRAB_Download_DataType.gain, image_scan_num)
+    if len(gain_headers) > 0:
+        values["gain_width"], values["gain_height"] = get_common_shape(imageset_name, gain_headers)
+    return imageset_name, values
+
+def update_dataset_dimensions(collection_name: str="empiar_dataset", num_workers: int=16, image_scan_num: int=16):
+    """
+    Fill the image / gain dimensions of the dataset documents from the headers of the downloaded files,
+    only the headers are read and the collection is updated in one bulk write
+    """
+    col = get_dataset(collection_name)
+    docs = list(col.find({}, {"_id": 0, "imageset_name": 1, "image_width": 1, "image_height": 1}))
+    results = start_work_ppe(update_dataset_dimensions_workfn, docs, show_tqdm=True, num_workers=num_workers, image_scan_num=image_scan_num)
+    imageset_values = {imageset_name: values for imageset_name, values in results}
+    modified_num = update_dataset_col_with_values(col, imageset_values)
+    logger.info(f"{PROJECT_NAME} update the dimensions of {modified_num} imagesets in {collection_name}")
+    return modified_num
@@ -0,0 +1,2 @@
+# Generate bin3A full-diff hdf5 shards
+from .step0_full_diff_h5_generation import load_full_diff_manifest, generate_full_diff_h5_shards
@@ -0,0 +1,116 @@
+import logging
+import functools
+import numpy as np
+from pathlib import Path
+
+logger = logging.getLogger()
+
+from CryoCRAB.utils import fft
+from CryoCRAB.utils.cache import Workspace
+from CryoCRAB.utils.fft_sizes import get_shapes_for_desired_psize
+from CryoCRAB.utils.micrograph import pad_mic_with_mean, trim_mic, contrast_normalization, estimate_background_ft, get_workspace_buffer
+from CryoCRAB.utils.ctf import compute_ctf_batch
+
+FLOAT16_MAX = 65504
+
+@functools.lru_cache(maxsize=16)
+def get_full_diff_geometry(frame_shape_in: tuple, psize_in: float, desired_psize_A: float=3.0):
+    """
+    Get the bin3A geometry (padded sizes, output pixel size and output shape) of a micrograph,
+    cached per process since all micrographs of an imageset share the same geometry
+    """
+    N_in, N_out, psize_out, downfactor, frame_shape_out = get_shapes_for_desired_psize(psize_in, frame_shape_in, desired_psize_A)
+    frame_shape_out = tuple(int(x) for x in frame_shape_out)
+    return N_in, N_out, psize_out, frame_shape_out
+
+def full_diff_to_bin3A(
+    bin1_full: np.ndarray,
+    bin1_diff: np.ndarray,
+    defocus_u: float,
+    defocus_v: float,
+    defocus_angle_rad: float,
+    accel_kv: float,
+    cs_mm: float,
+    amp_contrast: float,
+    phase_shift_rad: float,
+    psize_in: float,
+    desired_psize_A: float=3.0,
+    workspace: Workspace=None,
+) -> dict:
+    """
+    Convert a bin1 full-diff micrograph pair into the bin3A CTF filtered and contrast clipped full-diff pair
+
+    full = even + odd, diff = even - odd
+    """
+    frame_shape_in = tuple(int(x) for x in bin1_full.shape)
+    N_in, N_out, psize_out, frame_shape_out = get_full_diff_geometry(frame_shape_in, float(psize_in), float(desired_psize_A))
+    # the filter is specific to each micrograph, only its defocus independent terms of the grid are cached
+    ctffilt = compute_ctf_batch(
+        defocus_u=defocus_u,
+        defocus_v=defocus_v,
+        defocus_angle_rad=defocus_angle_rad,
+        accel_kv=accel_kv,
+        cs_mm=cs_mm,
+        amp_contrast=amp_contrast,
+        phase_shift_rad=phase_shift_rad,
+        N_out=N_out,
+        psize_out=psize_out,
+    )[0]
+
+    # one forward FFT of the (full, diff) stack at N_in, cropped to N_out
+    bin1_full_diff = get_workspace_buffer(workspace, "full_diff.pad", (2, N_in, N_in), np.float32)
+    if bin1_full_diff is None:
+        bin1_full_diff = np.empty((2, N_in, N_in), np.float32)
+    pad_mic_with_mean(bin1_full, N_in, out=bin1_full_diff[0])
+    pad_mic_with_mean(bin1_diff, N_in, out=bin1_full_diff[1])
+    full_diff_ft = fft.rfft2_center(bin1_full_diff)
+    bin3A_full_diff_ft = fft.ZT(full_diff_ft, N_out, stack=True, res=get_workspace_buffer(workspace, "full_diff.ft", (2, N_out, N_out//2+1), full_diff_ft.dtype))
+
+    # subtract background of full in fourier space at N_out
+    bin3A_full_diff_ft[0] -= estimate_background_ft(full_diff_ft[0], frame_shape_in, psize_in, N_out, workspace)
+
+    # even and odd go through the CTF filter and one inverse FFT as one (2, Y, X) stack
+    bin3A_full_ft, bin3A_diff_ft = bin3A_full_diff_ft
+    bin3A_even_odd_ft = np.stack([bin3A_full_ft + bin3A_diff_ft, bin3A_full_ft - bin3A_diff_ft])
+    bin3A_even_odd_ft *= 0.5 * ctffilt
+    bin3A_even, bin3A_odd = trim_mic( fft.irfft2_center( bin3A_even_odd_ft ), frame_shape_out)
+
+    even_vmin, even_vmax = contrast_normalization(bin3A_even)
+    odd_vmin, odd_vmax = contrast_normalization(bin3A_odd)
+    bin3A_even = bin3A_even.clip(even_vmin, even_vmax)
+    bin3A_odd = bin3A_odd.clip(odd_vmin, odd_vmax)
+
+    bin3A_full = bin3A_even + bin3A_odd
+    bin3A_diff = bin3A_even - bin3A_odd
+
+    full_vmin, full_vmax = contrast_normalization(bin3A_full)
+    bin3A_full = bin3A_full.clip(full_vmin, full_vmax)
+
+    bin3A_full = bin3A_full.clip(-FLOAT16_MAX, FLOAT16_MAX)
+    bin3A_diff = bin3A_diff.clip(-FLOAT16_MAX, FLOAT16_MAX)
+
+    attrs = {
+        "even_vmin": even_vmin, "even_vmax": even_vmax,
+        "odd_vmin": odd_vmin, "odd_vmax": odd_vmax,
+        "full_vmin": full_vmin, "full_vmax": full_vmax,
+        "full_mean": np.nanmean(bin3A_full), "full_std": np.nanstd(bin3A_full),
+        "even_mean": np.nanmean(bin3A_even), "even_std": np.nanstd(bin3A_even),
+        "odd_mean": np.nanmean(bin3A_odd), "odd_std": np.nanstd(bin3A_odd),
+        "psize": psize_out,
+    }
+    attrs = {key: float(value) for key, value in attrs.items()}
+
+    return {
+        "full": bin3A_full.astype(np.float16),
+        "diff": bin3A_diff.astype(np.float16),
+        "attrs": attrs,
+    }
+
+def get_full_diff_name(full_mrc_path: str):
+    """
+    Get the micrograph name of a full-diff pair, e.g. 049461_empiar_10736_full.mrc -> 049461_empiar_10736
+    """
+    name = Path(full_mrc_path).stem
+    if name.endswith("_full"):
+        name = name[:-len("_full")]
+    return name
@@ -0,0 +1,110 @@
+import logging
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from pathlib import Path
+from typing import Union
+logger = logging.getLogger()
+
+from CryoCRAB.utils import get_project_name, get_project_save_dir
+from CryoCRAB.utils.parallel import SafePPE, SharedArray
+from CryoCRAB.utils.cache import get_workspace
+from CryoCRAB.utils.cryocrab_io import MRC_IO, H5_Shard_Writer
+PROJECT_NAME = get_project_name()
+PROJECT_SAVE_DIR = get_project_save_dir()
+
+from .helper_func import full_diff_to_bin3A, get_full_diff_name
+
+FULL_DIFF_H5_DIR = Path(PROJECT_SAVE_DIR) / "Data" / "cryocrab-h5" / "full_diff"
+FULL_DIFF_H5_PREFIX = "full_diff"
+
+FULL_DIFF_MANIFEST_COLUMNS = [
+    "full_mrc_path", "diff_mrc_path",
+    "defocus_u", "defocus_v", "defocus_angle_rad",
+    "accel_kv", "cs_mm", "amp_contrast", "phase_shift_rad",
+    "psize_in",
+]
+
+def load_full_diff_manifest(manifest: Union[str, Path, pd.DataFrame, list[dict]]) -> list[dict]:
+    """
+    Load the full-diff manifest, one row per micrograph with the columns of FULL_DIFF_MANIFEST_COLUMNS
+    and an optional "name" column
+    """
+    if isinstance(manifest, (str, Path)):
+        manifest = pd.read_csv(manifest)
+    if isinstance(manifest, pd.DataFrame):
+        manifest = manifest.to_dict(orient="records")
+    items = []
+    for item in manifest:
+        missing = [key for key in FULL_DIFF_MANIFEST_COLUMNS if key not in item]
+        if len(missing) > 0:
+            raise ValueError(f"Manifest item {item} misses columns {missing}")
+        item = dict(item)
+        if item.get("name", None) is None or (type(item["name"]) is float and np.isnan(item["name"])):
+            item["name"] = get_full_diff_name(item["full_mrc_path"])
+        items.append(item)
+    return items
+
+def generate_full_diff_h5_workfn(item: dict, desired_psize_A: float=3.0):
+    """
+    Read a full-diff MRC pair and convert it into the bin3A full-diff pair
+    """
+    try:
+        # memory-mapped, float32 MRC files are read straight into the padded FFT buffers without a copy
+        bin1_full, _ = MRC_IO().read_mmap(item["full_mrc_path"], dtype=np.float32) # even + odd
+        bin1_diff, _ = MRC_IO().read_mmap(item["diff_mrc_path"], dtype=np.float32) # even - odd
+        result = full_diff_to_bin3A(
+            bin1_full=bin1_full,
+            bin1_diff=bin1_diff,
+            defocus_u=item["defocus_u"],
+            defocus_v=item["defocus_v"],
+            defocus_angle_rad=item["defocus_angle_rad"],
+            accel_kv=item["accel_kv"],
+            cs_mm=item["cs_mm"],
+            amp_contrast=item["amp_contrast"],
+            phase_shift_rad=item["phase_shift_rad"],
+            psize_in=item["psize_in"],
+            desired_psize_A=desired_psize_A,
+            workspace=get_workspace(),
+        )
+        # the bin3A pair goes back to the parent through shared memory instead of the result pipe
+        result["full"] = SharedArray.from_array(result["full"])
+        result["diff"] = SharedArray.from_array(result["diff"])
+    except Exception as e:
+        logger.warning(f"Failed to generate full-diff h5 for {item['name']}: {e}")
+        result = None
+    return result
+
+def generate_full_diff_h5_shards(
+    manifest: Union[str, Path, pd.DataFrame, list[dict]],
+    save_dir: Union[str, Path] = None,
+    shard_size: int = 256,
+    num_workers: int = 8,
+    desired_psize_A: float = 3.0,
+    chunks: tuple = (256, 256),
+    compression: str = "zstd",
+):
+    """
+    Generate the bin3A full-diff HDF5 shards of all micrographs in the manifest.
+    Micrographs are processed across a process pool and streamed into compressed shards of shard_size groups
+    with a sidecar index (see H5_Shard_Writer), micrographs already in the index are skipped.
+    """
+    items = load_full_diff_manifest(manifest)
+    save_dir = Path(FULL_DIFF_H5_DIR if save_dir is None else save_dir)
+
+    PPE = SafePPE(num_workers=num_workers)
+    tqdm_bar = tqdm(total=len(items), desc="Generate full-diff h5")
+    with H5_Shard_Writer(save_dir, shard_size=shard_size, chunks=chunks, compression=compression, prefix=FULL_DIFF_H5_PREFIX) as writer:
+        todo_items = [item for item in items if item["name"] not in writer]
+        tqdm_bar.update(len(items) - len(todo_items))
+        # results are written as they finish, at most max_in_flight micrographs are held in memory
+        for index, result in PPE.iter_work(generate_full_diff_h5_workfn, todo_items, max_in_flight=num_workers * 2, desired_psize_A=desired_psize_A):
+            if result is not None:
+                with result["full"] as full, result["diff"] as diff:
+                    writer.write(todo_items[index]["name"], {"full": full.array, "diff": diff.array}, result["attrs"])
+            tqdm_bar.update(1)
+        num_written = writer.num_written
+    tqdm_bar.close()
+    PPE.shutdown()
+    logger.info(f"{PROJECT_NAME} save {num_written} full-diff pairs to {save_dir}")
+    return num_written
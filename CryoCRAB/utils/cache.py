@@ -0,0 +1,131 @@
+import os
+import logging
+import functools
+from collections import OrderedDict
+import numpy as np
+
+logger = logging.getLogger()
+
+class ArrayLRUCache:
+    """
+    LRU cache of read-only numpy arrays with a memory ceiling in bytes
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._arrays = OrderedDict()
+
+    def get(self, key, compute_fn):
+        """
+        Get the array of key, computing it with compute_fn() on a miss
+        """
+        if key in self._arrays:
+            self.hits += 1
+            self._arrays.move_to_end(key)
+            return self._arrays[key]
+        self.misses += 1
+        arr = compute_fn()
+        arr.flags.writeable = False
+        if arr.nbytes <= self.max_bytes:
+            self._arrays[key] = arr
+            self.nbytes += arr.nbytes
+            self.evict()
+        return arr
+
+    def evict(self):
+        """
+        Evict the least recently used arrays until the cache fits in max_bytes
+        """
+        while self.nbytes > self.max_bytes and len(self._arrays) > 0:
+            _, arr = self._arrays.popitem(last=False)
+            self.nbytes -= arr.nbytes
+
+    def set_max_bytes(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.evict()
+
+    def clear(self):
+        self._arrays.clear()
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self._arrays)
+
+    def __repr__(self):
+        return f"ArrayLRUCache({len(self)} arrays, {self.nbytes / 2**20:.1f}/{self.max_bytes / 2**20:.1f} MB, {self.hits} hits, {self.misses} misses)"
+
+# one cache per process, 1 GB by default
+ARRAY_CACHE = ArrayLRUCache(int(float(os.getenv("CRYOCRAB_ARRAY_CACHE_MB", 1024)) * 2**20))
+
+def set_array_cache_max_mb(max_mb: float):
+    """
+    Set the memory ceiling of the array cache of this process
+    """
+    ARRAY_CACHE.set_max_bytes(int(max_mb * 2**20))
+
+def get_array_cache() -> ArrayLRUCache:
+    return ARRAY_CACHE
+
+def make_hashable(value):
+    """
+    Convert shapes given as lists / arrays and numpy scalars into a hashable cache key
+    """
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return tuple(make_hashable(v) for v in value)
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.dtype) or isinstance(value, type):
+        return np.dtype(value).str
+    return value
+
+def array_cache(func):
+    """
+    Memoize a function returning a numpy array in ARRAY_CACHE, keyed by its arguments.
+    The returned arrays are read-only and shared, copy them before modifying.
+    """
+    @functools.wraps(func)
+    def func_wrapper(*args, **kwargs):
+        key = (func.__module__, func.__qualname__, make_hashable(args), make_hashable(sorted(kwargs.items())))
+        return ARRAY_CACHE.get(key, lambda: func(*args, **kwargs))
+    return func_wrapper
+
+class Workspace:
+    """
+    Per-process pool of reusable buffers keyed by (name, shape, dtype), threaded through
+    the micrograph functions to avoid allocating N x N arrays for every micrograph.
+    A buffer is only valid until the next get() of the same key, so each function uses its own names.
+    """
+    def __init__(self):
+        self._buffers = {}
+
+    def get(self, name: str, shape: tuple, dtype=np.float32) -> np.ndarray:
+        """
+        Get the (uninitialized) buffer of name, shape and dtype
+        """
+        key = (name, tuple(int(x) for x in shape), np.dtype(dtype))
+        if key not in self._buffers:
+            self._buffers[key] = np.empty(key[1], dtype)
+        return self._buffers[key]
+
+    @property
+    def nbytes(self):
+        return sum(arr.nbytes for arr in self._buffers.values())
+
+    def clear(self):
+        self._buffers.clear()
+
+    def __len__(self):
+        return len(self._buffers)
+
+    def __repr__(self):
+        return f"Workspace({len(self)} buffers, {self.nbytes / 2**20:.1f} MB)"
+
+WORKSPACE = Workspace()
+
+def get_workspace() -> Workspace:
+    """
+    Get the workspace of this process, e.g. kept by a worker across all its micrographs
+    """
+    return WORKSPACE
@@ -2,7 +2,11 @@ import os
 import datetime
 import logging
 import json
+import queue
+import threading
+from collections import OrderedDict
 import mrcfile 
+import h5py
 from typing import Union
 from tqdm import tqdm
 import pandas as pd
@@ -12,6 +16,11 @@ from pymongo.collection import Collection
 from pathlib import Path
 logger = logging.getLogger()
 
+try:
+    import hdf5plugin # registers the lz4 / zstd / blosc filters in h5py, for both writing and reading
+except ImportError:
+    hdf5plugin = None
+
 from . import get_project_name, get_project_save_dir
 
 PROJECT_NAME = get_project_name()
@@ -42,20 +51,49 @@ class MRC_IO(IO):
     def __init__(self):
         super().__init__(CryoCRAB_Image_SuffixType.mrc)
     
-    def read(self, filepath: FILEPATH, dtype=np.float16):
+    def read(self, filepath: FILEPATH, dtype=np.float16, roi: tuple = None):
+        """
+        Read MRC file (or its roi, see read_mmap) into memory as dtype
         """
-        Read MRC file
+        data, header = self.read_mmap(filepath, roi=roi)
+        if data is not None:
+            data = np.array(data, dtype=dtype)
+        return data, header
+
+    def read_mmap(self, filepath: FILEPATH, roi: tuple = None, dtype=None):
+        """
+        Read MRC file as a read-only memory-mapped view, nothing is loaded until the data is accessed.
+        roi is an index into the data, e.g. 0 for the first frame of a movie stack or 
+        np.s_[..., 0:512, 0:512] for a crop, and stays a view of the file.
+        The (roi of the) data is only converted, i.e. loaded, if dtype differs from the dtype of the file.
         """
         try:
-            with mrcfile.open(filepath, mode='r+', permissive=True) as mrc:
-                data = mrc.data.astype(dtype)
-                header = mrc.header
+            with mrcfile.mmap(filepath, mode='r', permissive=True) as mrc:
+                # the memmap stays valid after the file is closed
+                data = mrc.data
+                header = mrc.header.copy()
+            if roi is not None:
+                data = data[roi]
+            if dtype is not None and data.dtype != np.dtype(dtype):
+                data = np.asarray(data, dtype=dtype)
         except Exception as e:
             data = None 
             header = None 
             logger.warning(f"Could not read MRC file {filepath}")
         return data, header
 
+    def read_header(self, filepath: FILEPATH):
+        """
+        Read MRC header only, without touching the data block
+        """
+        try:
+            with mrcfile.open(filepath, mode='r', permissive=True, header_only=True) as mrc:
+                header = mrc.header.copy()
+        except Exception as e:
+            header = None 
+            logger.warning(f"Could not read MRC header {filepath}")
+        return header
+
     def write(self, filepath: FILEPATH, data: np.ndarray, dtype=np.float16):
         """
         Write MRC file
@@ -66,3 +104,381 @@ class MRC_IO(IO):
         except Exception as e:
             logger.warning(f"Could not write MRC file {filepath}")
 
+
+
+# ----------------------------------------------------- HDF5 SHARDS
+# Many samples (one group of equally shaped 2D arrays + scalar attrs each) are packed into
+# shard files of shard_size groups, instead of one small file per micrograph.
+# A sidecar CSV index maps every sample to its shard, group and shape and keeps its attrs,
+# so readers can locate and filter samples without opening the shards.
+
+H5_SHARD_FILENAME = "{prefix}_{shard_idx:05d}.h5"
+H5_SHARD_INDEX_FILENAME = "index.csv"
+H5_SHARD_INDEX_COLUMNS = ["name", "shard", "shard_index", "height", "width", "dtype"]
+
+def get_h5_compression_kwargs(compression: str = "zstd", level: int = None) -> dict:
+    """
+    Get the create_dataset kwargs of a compression filter: None, gzip, lzf (built in h5py),
+    lz4, zstd, blosc (hdf5plugin, falls back to lzf if hdf5plugin is not installed).
+    The byte shuffle filter is always applied before compression, it helps a lot for float16.
+    """
+    if compression is None or compression == "none":
+        return {}
+    if compression in ["lz4", "zstd", "blosc"] and hdf5plugin is None:
+        logger.warning(f"Compression {compression} needs hdf5plugin (pip install hdf5plugin), use lzf instead")
+        compression = "lzf"
+    if compression == "gzip":
+        return {"compression": "gzip", "compression_opts": 4 if level is None else level, "shuffle": True}
+    elif compression == "lzf":
+        return {"compression": "lzf", "shuffle": True}
+    elif compression == "lz4":
+        return {**hdf5plugin.LZ4(), "shuffle": True}
+    elif compression == "zstd":
+        return {**hdf5plugin.Zstd(clevel=3 if level is None else level), "shuffle": True}
+    elif compression == "blosc":
+        # blosc shuffles by itself
+        return {**hdf5plugin.Blosc(cname="zstd", clevel=5 if level is None else level, shuffle=hdf5plugin.Blosc.SHUFFLE)}
+    else:
+        raise ValueError(f"Unknown compression {compression}")
+
+def get_h5_shard_index_path(save_dir: FILEPATH) -> Path:
+    return Path(save_dir) / H5_SHARD_INDEX_FILENAME
+
+def load_h5_shard_index(save_dir: FILEPATH) -> pd.DataFrame:
+    """
+    Load the sidecar index of a shard directory, empty if there is none
+    """
+    index_path = get_h5_shard_index_path(save_dir)
+    if not index_path.exists():
+        return pd.DataFrame(columns=H5_SHARD_INDEX_COLUMNS)
+    return pd.read_csv(index_path)
+
+def save_h5_shard_index(save_dir: FILEPATH, index: pd.DataFrame):
+    """
+    Save the sidecar index of a shard directory, written to a temporary file first so readers never see a partial index
+    """
+    index_path = get_h5_shard_index_path(save_dir)
+    tmp_path = index_path.with_suffix(".csv.tmp")
+    index.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, index_path)
+
+def get_h5_sample_index_row(shard: str, shard_index: int, name: str, group: h5py.Group) -> dict:
+    """
+    Get the index row of a sample group, its attrs become columns
+    """
+    shape, dtype = None, None
+    for key in group:
+        shape, dtype = group[key].shape, group[key].dtype
+        break
+    row = {
+        "name": name, "shard": shard, "shard_index": shard_index,
+        "height": shape[-2] if shape is not None else 0, "width": shape[-1] if shape is not None else 0,
+        "dtype": np.dtype(dtype).str if dtype is not None else "",
+    }
+    row.update({key: value.item() if isinstance(value, np.generic) else value for key, value in group.attrs.items()})
+    return row
+
+def get_h5_shard_prefix(save_dir: FILEPATH) -> str:
+    """
+    Get the shard prefix of a shard directory from its index, None if there is no index
+    """
+    shards = load_h5_shard_index(save_dir)["shard"]
+    if len(shards) == 0:
+        return None
+    return Path(shards.iloc[0]).stem.rsplit("_", 1)[0]
+
+def rebuild_h5_shard_index(save_dir: FILEPATH, prefix: str = None) -> pd.DataFrame:
+    """
+    Rebuild the sidecar index of a shard directory from the shards, e.g. if it is lost or outdated.
+    The prefix is taken from the current index if not given. shard_index follows the write order of the samples,
+    which is only known for shards created with track_order (all shards of H5_Shard_Writer).
+    """
+    if prefix is None:
+        prefix = get_h5_shard_prefix(save_dir)
+        if prefix is None:
+            raise ValueError(f"No index in {save_dir} to take the shard prefix from, please provide the prefix")
+    shard_paths = sorted(Path(save_dir).glob(f"{prefix}_*.h5"))
+    if len(shard_paths) == 0:
+        logger.warning(f"No {prefix}_*.h5 shards in {save_dir}, the index is empty")
+    rows = []
+    for shard_path in shard_paths:
+        with h5py.File(shard_path, "r") as f:
+            if not f["/"].id.get_create_plist().get_link_creation_order():
+                logger.warning(f"{shard_path} does not track the write order, its shard_index is in name order")
+            # the root group of a track_order file iterates in creation order
+            for shard_index, name in enumerate(f):
+                rows.append(get_h5_sample_index_row(shard_path.name, shard_index, name, f[name]))
+    index = pd.DataFrame(rows, columns=None if len(rows) > 0 else H5_SHARD_INDEX_COLUMNS)
+    save_h5_shard_index(save_dir, index)
+    return index
+
+class H5_Shard_Writer:
+    """
+    Append samples to the sharded HDF5 files of save_dir, each sample a group of equally shaped 2D arrays
+    and scalar attrs. Writing resumes after the samples already in the index, a shard is closed
+    and the index saved every shard_size samples.
+    """
+    def __init__(
+        self,
+        save_dir: FILEPATH,
+        shard_size: int = 256,
+        chunks: tuple = (256, 256),
+        compression: str = "zstd",
+        compression_level: int = None,
+        prefix: str = "shard",
+    ):
+        self.save_dir = Path(save_dir)
+        self.save_dir.mkdir(parents=True, exist_ok=True)
+        self.shard_size = shard_size
+        self.chunks = tuple(chunks)
+        self.compression_kwargs = get_h5_compression_kwargs(compression, compression_level)
+        self.prefix = prefix
+
+        self.index_rows = load_h5_shard_index(self.save_dir).to_dict(orient="records")
+        self.names = set(row["name"] for row in self.index_rows)
+        # continue after the last shard, a partially filled shard is not reopened
+        shards = sorted(set(row["shard"] for row in self.index_rows))
+        self.shard_idx = int(Path(shards[-1]).stem.split("_")[-1]) + 1 if len(shards) > 0 else 0
+        self.shard_file = None
+        self.shard_num = 0
+        self.num_written = 0
+
+    def get_shard_path(self, shard_idx: int) -> Path:
+        return self.save_dir / H5_SHARD_FILENAME.format(prefix=self.prefix, shard_idx=shard_idx)
+
+    def __contains__(self, name: str):
+        return name in self.names
+
+    def __len__(self):
+        return len(self.names)
+
+    def write(self, name: str, arrays: dict[str, np.ndarray], attrs: dict = None):
+        """
+        Write one sample, e.g. write("049461_empiar_10736", {"full": full, "diff": diff}, {"full_mean": 0.1, ...})
+        """
+        if name in self.names:
+            logger.warning(f"Sample {name} is already in {self.save_dir}, skip")
+            return
+        shapes = set(arr.shape for arr in arrays.values())
+        if len(shapes) != 1:
+            raise ValueError(f"Arrays of sample {name} have different shapes {shapes}")
+        if self.shard_file is None:
+            # the write order is kept, so rebuild_h5_shard_index gives the same shard_index
+            self.shard_file = h5py.File(self.get_shard_path(self.shard_idx), "w", track_order=True)
+            self.shard_num = 0
+
+        group = self.shard_file.create_group(name)
+        for key, arr in arrays.items():
+            chunks = tuple(min(c, s) for c, s in zip(self.chunks, arr.shape))
+            group.create_dataset(key, data=arr, chunks=chunks, **self.compression_kwargs)
+        for key, value in (attrs or {}).items():
+            group.attrs[key] = value
+
+        self.index_rows.append(get_h5_sample_index_row(self.get_shard_path(self.shard_idx).name, self.shard_num, name, group))
+        self.names.add(name)
+        self.shard_num += 1
+        self.num_written += 1
+        if self.shard_num >= self.shard_size:
+            self.close_shard()
+
+    def close_shard(self):
+        """
+        Close the current shard and save the index
+        """
+        if self.shard_file is None:
+            return
+        self.shard_file.close()
+        self.shard_file = None
+        self.shard_idx += 1
+        save_h5_shard_index(self.save_dir, pd.DataFrame(self.index_rows))
+
+    def close(self):
+        self.close_shard()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+# ----------------------------------------------------- HDF5 SHARD READER
+# Random-access reader of the full-diff shards for training: only the chunks under a random crop are read
+# and decompressed, even / odd and the normalization are derived on the fly from the index.
+# Works as a PyTorch map-style Dataset (len + getitem returning numpy arrays) without depending on torch.
+
+FULL_DIFF_KEYS = ["full", "diff", "even", "odd"]
+
+class H5_Full_Diff_Dataset:
+    """
+    Random crops of the full-diff samples of a shard directory, sample i is a dict of crop_size x crop_size float32 arrays of keys.
+    With align_crops the crop origins are multiples of the chunk shape, so a crop touches the fewest chunks.
+    File handles are opened lazily and kept per process (max_open_files), so the dataset is safe to use in forked workers.
+    """
+    def __init__(
+        self,
+        save_dir: FILEPATH,
+        crop_size: int = 256,
+        keys: list[str] = ["full", "even", "odd"],
+        normalize: bool = True,
+        align_crops: bool = True,
+        seed: int = None,
+        max_open_files: int = 64,
+    ):
+        for key in keys:
+            if key not in FULL_DIFF_KEYS:
+                raise ValueError(f"Unknown key {key}, should be in {FULL_DIFF_KEYS}")
+        self.save_dir = Path(save_dir)
+        self.index = load_h5_shard_index(self.save_dir)
+        self.crop_size = crop_size
+        self.keys = list(keys)
+        self.normalize = normalize
+        self.align_crops = align_crops
+        self.seed = seed
+        self.max_open_files = max_open_files
+        self._pid = None
+        self._files = OrderedDict()
+        self._rng = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def check_process(self):
+        """
+        Drop the handles and the random generator inherited from the parent process
+        """
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._files = OrderedDict()
+            self._rng = np.random.default_rng(None if self.seed is None else [self.seed, self._pid])
+
+    def get_file(self, shard: str) -> h5py.File:
+        """
+        Get the open handle of a shard, closing the least recently used one above max_open_files
+        """
+        self.check_process()
+        if shard in self._files:
+            self._files.move_to_end(shard)
+            return self._files[shard]
+        self._files[shard] = h5py.File(self.save_dir / shard, "r")
+        while len(self._files) > self.max_open_files:
+            _, f = self._files.popitem(last=False)
+            f.close()
+        return self._files[shard]
+
+    def get_crop_slices(self, shape: tuple, chunks: tuple):
+        """
+        Get the (y, x) slices of a random crop, aligned to chunks if align_crops
+        """
+        slices = []
+        for size, chunk in zip(shape, chunks):
+            max_start = max(size - self.crop_size, 0)
+            step = chunk if self.align_crops and chunk is not None else 1
+            start = int(self._rng.integers(0, max_start // step + 1)) * step
+            slices.append(slice(start, start + self.crop_size))
+        return tuple(slices)
+
+    def read_crop(self, i: int, crop_slices: tuple = None) -> dict:
+        """
+        Read the crop of sample i (a random one if crop_slices is None) and derive the arrays of keys.
+        Crops of micrographs smaller than crop_size are zero padded.
+        """
+        row = self.index.iloc[i]
+        group = self.get_file(row["shard"])[row["name"]]
+        if crop_slices is None:
+            crop_slices = self.get_crop_slices(group["full"].shape, group["full"].chunks or (None, None))
+        full = group["full"][crop_slices].astype(np.float32)
+        diff = group["diff"][crop_slices].astype(np.float32)
+
+        arrays = {}
+        for key in self.keys:
+            if key == "full":
+                arr = full
+            elif key == "diff":
+                arr = diff
+            elif key == "even":
+                arr = (full + diff) * 0.5
+            else:
+                arr = (full - diff) * 0.5
+            if self.normalize and key != "diff":
+                arr = (arr - row[f"{key}_mean"]) / row[f"{key}_std"]
+            if arr.shape != (self.crop_size, self.crop_size):
+                arr = np.pad(arr, [(0, self.crop_size - s) for s in arr.shape])
+            arrays[key] = arr.astype(np.float32, copy=False)
+        return arrays
+
+    def __getitem__(self, i: int) -> dict:
+        self.check_process()
+        return self.read_crop(int(i))
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files.clear()
+
+    def __getstate__(self):
+        # open handles are never pickled, e.g. when the dataset is sent to spawned workers
+        state = self.__dict__.copy()
+        state["_pid"], state["_files"], state["_rng"] = None, OrderedDict(), None
+        return state
+
+class H5_Prefetch_Loader:
+    """
+    Iterate over batches of a H5_Full_Diff_Dataset, the next prefetch batches are read on a background thread
+    while the current one is consumed. Each batch is a dict of (batch_size, crop_size, crop_size) arrays and the sample indices.
+    """
+    def __init__(self, dataset: H5_Full_Diff_Dataset, batch_size: int = 32, shuffle: bool = True, drop_last: bool = True, prefetch: int = 2, seed: int = None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.prefetch = prefetch
+        self.rng = np.random.default_rng(seed)
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.dataset) // self.batch_size
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def get_batch_indices(self):
+        indices = self.rng.permutation(len(self.dataset)) if self.shuffle else np.arange(len(self.dataset))
+        return [indices[st:st+self.batch_size] for st in range(0, len(self) * self.batch_size, self.batch_size)]
+
+    def read_batch(self, batch_indices: np.ndarray) -> dict:
+        samples = [self.dataset[i] for i in batch_indices]
+        batch = {key: np.stack([sample[key] for sample in samples]) for key in samples[0]}
+        batch["index"] = np.asarray(batch_indices)
+        return batch
+
+    def __iter__(self):
+        batch_queue = queue.Queue(maxsize=self.prefetch)
+        stop_event = threading.Event()
+        end = object()
+
+        def producer():
+            try:
+                for batch_indices in self.get_batch_indices():
+                    if stop_event.is_set():
+                        return
+                    batch_queue.put(self.read_batch(batch_indices))
+                batch_queue.put(end)
+            except Exception as e:
+                batch_queue.put(e)
+
+        thread = threading.Thread(target=producer, daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch = batch_queue.get()
+                if batch is end:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            # unblock the producer if the consumer stops early
+            stop_event.set()
+            while thread.is_alive():
+                try:
+                    batch_queue.get_nowait()
+                except queue.Empty:
+                    thread.join(timeout=0.1)
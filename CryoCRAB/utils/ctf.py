@@ -1,5 +1,6 @@
 import numpy as np
 from . import fft
+from .cache import array_cache
 
 # ================= 2D REAL CTF 
 def defocus_polar_to_cartesian(df1_A, df2_A, df_angle_rad):
@@ -15,13 +16,56 @@ def get_chi_consts ( akv, csmm, wgh, phase_shift):
     CTF4 = - np.pi * e**3 * (csmm*1e7) / 2.0
     chi_offset = phase_shift - np.arccos(wgh)
     return CTF2, CTF4, chi_offset
-def compute_ctf_chi_2D ( freqs, akv, csmm, wgh, DF,  dfxx, dfxy, phase_shift):
-    CTF2, CTF4, chi_offset = get_chi_consts ( akv, csmm, wgh, phase_shift)
+
+# ================= 2D REAL CTF, BATCHED 
+# chi is linear in the defocus independent terms (fx^2, 2 fx fy, fy^2, f^4) of the grid, which only depend 
+# on (N_out, psize_out) and are shared within an imageset, as is the butterworth highpass filter.
+# chi of a batch of micrographs is then one (B, 5) x (5, pixels) matrix product, with the constant term.
+
+def get_ctf_freq_terms(freqs):
+    """ (fx^2, 2 fx fy, fy^2, f^4, 1) of freqs, stacked along the first axis """
     fx = freqs[...,0]
     fy = freqs[...,1]
     f2 = (fx*fx + fy*fy)
-    chi = CTF2*((DF+dfxx)*fx*fx + 2*(dfxy)*fx*fy + (DF-dfxx)*fy*fy) + CTF4*f2*f2 + chi_offset
-    return chi
+    return np.stack([fx*fx, 2*fx*fy, fy*fy, f2*f2, np.ones_like(fx)])
+
+def get_ctf_highpass_filter_from_freqs(freqs, N_out, psize_out, D0=5.0, n=4):
+    """ butterworth highpass filter of order n and cutoff D0 (unit: pixel of the N_out grid) """
+    fx = freqs[...,0]
+    fy = freqs[...,1]
+    freqs_pix2 = (fx*fx + fy*fy) * (N_out*psize_out)**2
+    hpfilt = 1. - 1. / (1. + (freqs_pix2 / D0**2) ** n)
+    return hpfilt.astype(freqs.dtype, copy=False)
+
+@array_cache
+def get_ctf_grid_terms(N_out, psize_out, dtype=None):
+    """ get_ctf_freq_terms of the centered rfft grid of (N_out, N_out) with psize_out, cached """
+    return get_ctf_freq_terms(fft.get_rfft_center_freqs((N_out, N_out), psize_out, dtype))
+
+@array_cache
+def get_ctf_highpass_filter(N_out, psize_out, D0=5.0, n=4, dtype=None):
+    """ get_ctf_highpass_filter_from_freqs of the centered rfft grid of (N_out, N_out) with psize_out, cached """
+    return get_ctf_highpass_filter_from_freqs(fft.get_rfft_center_freqs((N_out, N_out), psize_out, dtype), N_out, psize_out, D0, n)
+
+def get_ctf_chi_coefs(akv, csmm, wgh, DF, dfxx, dfxy, phase_shift):
+    """ (B, 5) coefficients of get_ctf_freq_terms in chi, inputs are scalars or arrays of B micrographs """
+    CTF2, CTF4, chi_offset = get_chi_consts ( akv, csmm, wgh, phase_shift)
+    coefs = np.broadcast_arrays(CTF2*(DF+dfxx), CTF2*dfxy, CTF2*(DF-dfxx), CTF4, chi_offset)
+    return np.stack([np.atleast_1d(x) for x in coefs], axis=-1)
+
+def compute_ctf_filter_from_terms(terms, hpfilt, chi_coefs, min_chi=-1.50):
+    """
+    CTF filters (B, ...) of chi_coefs (B, 5) on the grid of terms (5, ...) and hpfilt (...):
+    Invert CTF up to first peak, phase-flip beyond first peak
+    """
+    chi = chi_coefs.astype(terms.dtype) @ terms.reshape(len(terms), -1)
+    chi = chi.reshape((len(chi_coefs),) + terms.shape[1:])
+    ctf = np.cos(np.maximum(chi, min_chi) if min_chi is not None else chi) # -1.50 corresponding to CTF=-0.07 or 1/CTF = ~14.3
+    # 1/ctf only where it is used, the phase flipped part has the CTF zeros
+    ctffilt = np.sign(ctf)
+    np.divide(1.0, ctf, out=ctffilt, where=chi < 0)
+    ctffilt *= hpfilt
+    return ctffilt
 
 def compute_ctf(
     defocus_u: float,
@@ -40,14 +84,15 @@ def compute_ctf(
 ):
     """
     Generate CTF filter: Invert CTF up to first peak, phase-flip beyond first peak
+    The filter has the dtype of freqs, float32 freqs (single precision) give a float32 filter.
+    For many micrographs of one geometry, compute_ctf_batch / iter_ctf_batch share the grid terms.
     """
     DFs, dfxxs, dfxys = defocus_polar_to_cartesian(
         df1_A=defocus_u, 
         df2_A=defocus_v, 
         df_angle_rad=defocus_angle_rad
     )
-    chi = compute_ctf_chi_2D(
-        freqs=freqs, 
+    chi_coefs = get_ctf_chi_coefs(
         akv=accel_kv, 
         csmm=cs_mm, 
         wgh=amp_contrast, 
@@ -56,14 +101,85 @@ def compute_ctf(
         dfxy=dfxys, 
         phase_shift=phase_shift_rad
     )
-    if min_chi is not None:
-        chi = np.maximum(chi, min_chi) # -1.50 corresponding to CTF=-0.07 or 1/CTF = ~14.3
-    ctf = np.cos(chi)
-    
-    freqs_pix = freqs*N_out*psize_out
-    hpfilt = 1. - 1. / (1. + (np.linalg.norm(freqs_pix, axis=-1) / D0) ** (2*n))
-    ctffilt = hpfilt
-    ctffilt[chi < 0] *= 1.0 / ctf[chi < 0]
-    ctffilt[chi >= 0] *= np.sign(ctf[chi >= 0])
+    ctffilt = compute_ctf_filter_from_terms(
+        terms=get_ctf_freq_terms(freqs),
+        hpfilt=get_ctf_highpass_filter_from_freqs(freqs, N_out, psize_out, D0, n),
+        chi_coefs=chi_coefs,
+        min_chi=min_chi,
+    )
     
-    return ctffilt
\ No newline at end of file
+    return ctffilt[0]
+
+def compute_ctf_batch(
+    defocus_u: np.ndarray,
+    defocus_v: np.ndarray,
+    defocus_angle_rad: np.ndarray,
+    accel_kv: float,
+    cs_mm: float,
+    amp_contrast: float,
+    phase_shift_rad: np.ndarray,
+    N_out: int,  
+    psize_out: float,
+    D0: float=5.0,
+    n: int=4,
+    min_chi: float=-1.50,
+    dtype=None,
+):
+    """
+    Generate the CTF filters (B, N_out, N_out//2+1) of B micrographs sharing one geometry (N_out, psize_out).
+    defocus_u/v/angle and phase_shift_rad are arrays of B micrographs (or scalars), the others usually scalars.
+    dtype defaults to the real dtype of the precision.
+    """
+    DFs, dfxxs, dfxys = defocus_polar_to_cartesian(
+        df1_A=np.asarray(defocus_u, np.float64), 
+        df2_A=np.asarray(defocus_v, np.float64), 
+        df_angle_rad=np.asarray(defocus_angle_rad, np.float64)
+    )
+    chi_coefs = get_ctf_chi_coefs(
+        akv=accel_kv, 
+        csmm=cs_mm, 
+        wgh=amp_contrast, 
+        DF=DFs, 
+        dfxx=dfxxs, 
+        dfxy=dfxys, 
+        phase_shift=np.asarray(phase_shift_rad, np.float64)
+    )
+    return compute_ctf_filter_from_terms(
+        terms=get_ctf_grid_terms(N_out, psize_out, dtype),
+        hpfilt=get_ctf_highpass_filter(N_out, psize_out, D0, n, dtype),
+        chi_coefs=chi_coefs,
+        min_chi=min_chi,
+    )
+
+def iter_ctf_batch(
+    defocus_u: np.ndarray,
+    defocus_v: np.ndarray,
+    defocus_angle_rad: np.ndarray,
+    accel_kv: float,
+    cs_mm: float,
+    amp_contrast: float,
+    phase_shift_rad: np.ndarray,
+    N_out: int,  
+    psize_out: float,
+    D0: float=5.0,
+    n: int=4,
+    min_chi: float=-1.50,
+    dtype=None,
+    batch_size: int=16,
+):
+    """
+    Generator of the CTF filters of compute_ctf_batch one micrograph at a time, 
+    computed batch_size micrographs at a time to bound the memory
+    """
+    params = np.broadcast_arrays(*[np.atleast_1d(np.asarray(x, np.float64)) for x in [defocus_u, defocus_v, defocus_angle_rad, accel_kv, cs_mm, amp_contrast, phase_shift_rad]])
+    for st in range(0, len(params[0]), batch_size):
+        ctffilts = compute_ctf_batch(
+            *[x[st:st+batch_size] for x in params], 
+            N_out=N_out, 
+            psize_out=psize_out, 
+            D0=D0, 
+            n=n, 
+            min_chi=min_chi, 
+            dtype=dtype,
+        )
+        yield from ctffilts
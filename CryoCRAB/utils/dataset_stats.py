@@ -0,0 +1,104 @@
+import logging
+import numpy as np
+from pymongo.collection import Collection
+logger = logging.getLogger()
+
+from .datatype import DeterminationMethod
+
+# ----------------------------------------------------- DATASET STATISTICS
+# All statistics run as MongoDB aggregation pipelines, only the grouped results are sent back
+# instead of every document with its path arrays.
+
+def get_suffix_expr(path_expr):
+    """
+    Aggregation expression of the suffix of a path, like os.path.splitext(path)[1]
+    """
+    suffix_match = {"$regexFind": {"input": path_expr, "regex": r"(?<!^)(?<!/)\.[^./]*$"}}
+    return {"$ifNull": [{"$let": {"vars": {"suffix_match": suffix_match}, "in": "$$suffix_match.match"}}, ""]}
+
+def get_min_image_num_expr(image_max_num=np.inf, image_num_field: str="image_num"):
+    """
+    Aggregation expression of min(image_num, image_max_num)
+    """
+    if np.isinf(image_max_num):
+        return f"${image_num_field}"
+    return {"$min": [f"${image_num_field}", int(image_max_num)]}
+
+def aggregate_counts(collection: Collection, pipeline: list[dict]) -> dict:
+    """
+    Run a pipeline ending in {"_id": key, "count": n} groups and return {key: n}
+    """
+    return {doc["_id"]: doc["count"] for doc in collection.aggregate(pipeline)}
+
+def get_total_image_num(collection: Collection, image_max_num=np.inf, query: dict=None) -> int:
+    """
+    Get the total image number, each dataset counting at most image_max_num images
+    """
+    pipeline = [
+        {"$match": query or {}},
+        {"$group": {"_id": None, "count": {"$sum": get_min_image_num_expr(image_max_num)}}},
+    ]
+    return aggregate_counts(collection, pipeline).get(None, 0)
+
+def get_image_num_by_field(collection: Collection, field: str, image_max_num=np.inf, query: dict=None) -> dict:
+    """
+    Get the image number per value of a field, e.g. {"EER": 120000, "TIFF": 30000} for image_type
+    """
+    pipeline = [
+        {"$match": query or {}},
+        {"$group": {"_id": f"${field}", "count": {"$sum": get_min_image_num_expr(image_max_num)}}},
+        {"$sort": {"count": -1}},
+    ]
+    return aggregate_counts(collection, pipeline)
+
+def get_dataset_num_by_field(collection: Collection, field: str, query: dict=None) -> dict:
+    """
+    Get the dataset (document) number per value of a field
+    """
+    pipeline = [
+        {"$match": query or {}},
+        {"$group": {"_id": f"${field}", "count": {"$sum": 1}}},
+        {"$sort": {"count": -1}},
+    ]
+    return aggregate_counts(collection, pipeline)
+
+def get_suffix_counts(collection: Collection, paths_field: str, num_field: str, query: dict=None, apply_image_max_num_filter: bool=False) -> dict:
+    """
+    Count the files per suffix. Without apply_image_max_num_filter each dataset counts num_field files
+    with the suffix of its first path, with it every stored path (at most image_max_num per dataset) is counted.
+    """
+    if apply_image_max_num_filter:
+        pipeline = [
+            {"$match": query or {}},
+            {"$project": {"_id": 0, paths_field: 1}},
+            {"$unwind": f"${paths_field}"},
+            {"$group": {"_id": get_suffix_expr(f"${paths_field}"), "count": {"$sum": 1}}},
+        ]
+    else:
+        pipeline = [
+            {"$match": {**(query or {}), num_field: {"$gt": 0}}},
+            {"$project": {"_id": 0, num_field: 1, "first_path": {"$arrayElemAt": [f"${paths_field}", 0]}}},
+            {"$group": {"_id": get_suffix_expr("$first_path"), "count": {"$sum": f"${num_field}"}}},
+        ]
+    return aggregate_counts(collection, pipeline)
+
+def get_image_and_gain_suffix_counts(collection: Collection, apply_image_max_num_filter: bool=False, query: dict=None) -> tuple[dict, dict]:
+    """
+    Count the image and gain files per suffix, of the SPA datasets by default
+    """
+    if query is None:
+        query = {"determination_method": DeterminationMethod.spa.value}
+    image_suffix_count_dict = get_suffix_counts(collection, "empiar_image_relative_paths", "image_num", query, apply_image_max_num_filter)
+    gain_suffix_count_dict = get_suffix_counts(collection, "empiar_gain_relative_paths", "gain_num", query, apply_image_max_num_filter)
+    return image_suffix_count_dict, gain_suffix_count_dict
+
+def get_dataset_summary(collection: Collection, image_max_num=np.inf, query: dict=None) -> dict:
+    """
+    Get the dataset / image numbers of a collection, overall and per image type and determination method
+    """
+    return {
+        "dataset_num": collection.count_documents(query or {}),
+        "image_num": get_total_image_num(collection, image_max_num, query),
+        "image_num_by_image_type": get_image_num_by_field(collection, "image_type", image_max_num, query),
+        "image_num_by_determination_method": get_image_num_by_field(collection, "determination_method", image_max_num, query),
+    }
@@ -1,6 +1,18 @@
+import os
+import json
+import logging
+from time import perf_counter
+from pathlib import Path
 from typing import List
 
 import numpy as np
+from tqdm import tqdm
+
+logger = logging.getLogger()
+
+# "cpu" for numpy/scipy.fft (pocketfft) and FFTW, "cufft" for the K40 cuFFT tables
+FFT_SIZE_TABLE = os.getenv("CRYOCRAB_FFT_SIZE_TABLE", "cpu")
+FFT_SIZES_AUTOTUNE_FILE = Path(os.getenv("CRYOCRAB_FFT_SIZES_FILE", Path.home() / ".cache" / "CryoCRAB" / "fft_sizes_autotune.json"))
 
 def fast_cufft_fft2_sizes_single() -> List[int]:
     """
@@ -44,10 +56,72 @@ def fast_cufft_fft3_sizes() -> List[int]:
             648,  672,  700,  720,  756,  768,  784,  810,  882,  900, 1024,
             1080, 1120, 1152]
 
+def get_smooth_fft_sizes(
+        min_size: int,
+        max_size: int,
+        multiple_of: int = 2,
+        max_factor7: int = 1) -> List[int]:
+    """
+    Sizes in [min_size, max_size] that are multiples of multiple_of and
+    7-smooth (only factors 2, 3, 5, 7) with at most max_factor7 factors of 7
+    """
+    sizes = []
+    for n in range(multiple_of * int(np.ceil(min_size / multiple_of)), max_size + 1, multiple_of):
+        m, factor7 = n, 0
+        for p in [2, 3, 5, 7]:
+            while m % p == 0:
+                m //= p
+                factor7 += int(p == 7)
+        if m == 1 and factor7 <= max_factor7:
+            sizes.append(n)
+    return sizes
+
+def fast_cpu_fft2_sizes_single() -> List[int]:
+    """
+    For single 2D arrays (e.g., micrographs)
+    CPU FFTs (pocketfft, FFTW) handle radices 2, 3, 5, 7 natively, sizes with
+    a large power of 2 are fastest, e.g. 5760 (2^7*3^2*5) beats 5832 (2^3*3^6)
+    """
+    return get_smooth_fft_sizes(512, 16384, multiple_of=16)
+
+def fast_cpu_fft2_sizes_batch() -> List[int]:
+    """
+    For multiple 2D arrays (e.g.,  particles)
+    """
+    return get_smooth_fft_sizes(32, 4096, multiple_of=4)
+
+def get_fast_sizes(
+        d: int = 2,
+        batch: bool = False,
+        table: str = None) -> List[int]:
+    """
+    Get the list of fast FFT sizes.
+
+    :param d: the dimension of the array (e.g., 2 or 3)
+    :type d: int
+    :param batch: if True, implies the search is for a 2D stack
+    of particles rather than a micrograph
+    :type batch: bool
+    :param table: "cpu" or "cufft", defaults to FFT_SIZE_TABLE
+    :type table: str
+
+    The full static table, the autotuned sizes only prune it in get_lowest_fast_size
+    """
+    assert d in [2, 3], "Dimension of array must be either 2 or 3"
+    table = FFT_SIZE_TABLE if table is None else table
+    assert table in ["cpu", "cufft"], "FFT size table must be either cpu or cufft"
+
+    if d == 3:
+        return fast_cufft_fft3_sizes()
+    if table == "cufft":
+        return fast_cufft_fft2_sizes_batch() if batch else fast_cufft_fft2_sizes_single()
+    return fast_cpu_fft2_sizes_batch() if batch else fast_cpu_fft2_sizes_single()
+
 def get_lowest_fast_size(
         frame_shape: int,
         d: int = 2,
-        batch: bool = False) -> int:
+        batch: bool = False,
+        table: str = None) -> int:
     """
     Using the optimized list of sizes tested to perform well in FFTs, find
     the next lowest size to use for an array.
@@ -59,15 +133,14 @@ def get_lowest_fast_size(
     :param batch: if True, implies the search is for a 2D stack
     of particles rather than a micrograph
     :type batch: bool
+    :param table: "cpu" (pruned by the autotuned sizes if available) or "cufft", defaults to FFT_SIZE_TABLE
+    :type table: str
     """
-    assert d in [2, 3], "Dimension of array must be either 2 or 3"
     q = np.max(frame_shape)
-
-    if d == 2:
-        fast_sizes = fast_cufft_fft2_sizes_batch(
-        ) if batch else fast_cufft_fft2_sizes_single()
-    elif d == 3:
-        fast_sizes = fast_cufft_fft3_sizes()
+    fast_sizes = get_fast_sizes(d, batch, table)
+    if d == 2 and (FFT_SIZE_TABLE if table is None else table) == "cpu":
+        # only the padded length is a matter of FFT speed
+        fast_sizes = prune_autotuned_fft2_sizes(fast_sizes, batch)
 
     hits = np.where(np.array(fast_sizes) >= q)[0]
     if len(hits) > 0:
@@ -78,7 +151,8 @@ def get_lowest_fast_size(
 def get_nearest_fast_size(
         frame_shape: int,
         d: int = 2,
-        batch: bool = False) -> int:
+        batch: bool = False,
+        table: str = None) -> int:
     """
     Using the optimized list of sizes tested to perform well in FFTs, find
     the nearest size that is fast.
@@ -90,25 +164,114 @@ def get_nearest_fast_size(
     :param batch: if True, implies the search is for a 2D stack
     of particles rather than a micrograph
     :type batch: bool
+    :param table: "cpu" or "cufft", defaults to FFT_SIZE_TABLE
+    :type table: str
     """
-    assert d in [2, 3], "Dimension of array must be either 2 or 3"
     q = np.max(frame_shape)
-
-    if d == 2:
-        fast_sizes = fast_cufft_fft2_sizes_batch(
-        ) if batch else fast_cufft_fft2_sizes_single()
-    elif d == 3:
-        fast_sizes = fast_cufft_fft3_sizes()
+    fast_sizes = get_fast_sizes(d, batch, table)
 
     diffs2 = (np.array(fast_sizes) - q)**2
     hit = np.argmin(diffs2)
     return fast_sizes[hit]
 
-def get_shapes_for_desired_psize(psize_in, frame_shape_in, psize_des):
+def get_shapes_for_desired_psize(psize_in, frame_shape_in, psize_des, table=None):
     # figure out downsampling factor
-    N_in = get_lowest_fast_size(frame_shape_in)
-    N_out = get_nearest_fast_size(psize_in * N_in / psize_des)
+    N_in = get_lowest_fast_size(frame_shape_in, table=table)
+    N_out = get_nearest_fast_size(psize_in * N_in / psize_des, table=table)
     psize_out = psize_in * N_in / N_out
     downfactor = N_out / N_in
     frame_shape_out = np.round(np.array(frame_shape_in)*downfactor).astype(int)
     return N_in, N_out, psize_out, downfactor, frame_shape_out
+
+# ----------------------------------------------------- AUTOTUNING
+
+_AUTOTUNED_FFT2_SIZES = {}
+
+def load_autotuned_fft2_sizes(batch: bool = False, autotune_path: Path = None):
+    """
+    Load the autotuned fast 2D sizes of this machine and the (min, max) benchmarked size, None if not autotuned yet
+    """
+    autotune_path = Path(FFT_SIZES_AUTOTUNE_FILE if autotune_path is None else autotune_path)
+    key = (str(autotune_path), batch)
+    if key not in _AUTOTUNED_FFT2_SIZES:
+        result = None
+        if autotune_path.exists():
+            with open(autotune_path, "r") as f:
+                autotuned = json.load(f).get("fft2_batch" if batch else "fft2_single", None)
+            if autotuned is not None:
+                benchmarked_sizes = [int(n) for n in autotuned["timings"].keys()]
+                result = autotuned["fast_sizes"], (min(benchmarked_sizes), max(benchmarked_sizes))
+        _AUTOTUNED_FFT2_SIZES[key] = result
+    return _AUTOTUNED_FFT2_SIZES[key]
+
+def prune_autotuned_fft2_sizes(fast_sizes: List[int], batch: bool = False) -> List[int]:
+    """
+    Drop the sizes within the benchmarked range that were slower than a larger size on this machine,
+    the sizes outside of it are kept
+    """
+    autotuned = load_autotuned_fft2_sizes(batch)
+    if autotuned is None:
+        return fast_sizes
+    autotuned_sizes, (min_size, max_size) = autotuned
+    autotuned_sizes = set(autotuned_sizes)
+    return [n for n in fast_sizes if n in autotuned_sizes or not min_size <= n <= max_size]
+
+def autotune_fft2_sizes(
+        min_size: int = 512,
+        max_size: int = 8192,
+        batch: bool = False,
+        num_repeats: int = 3,
+        autotune_path: Path = None) -> List[int]:
+    """
+    Benchmark the rfft2/irfft2 pair of the current FFT backend on all candidate
+    CPU sizes in [min_size, max_size] and keep only the sizes faster than every
+    larger candidate, so that get_lowest_fast_size picks the fastest size that fits.
+    The result is saved to autotune_path (FFT_SIZES_AUTOTUNE_FILE by default).
+
+    :param batch: if True, benchmark stacks of 16 particles instead of micrographs
+    :type batch: bool
+    :param num_repeats: number of timed transforms per size, the minimum is kept
+    :type num_repeats: int
+    """
+    from .fft import get_fft_backend
+    backend = get_fft_backend()
+    autotune_path = Path(FFT_SIZES_AUTOTUNE_FILE if autotune_path is None else autotune_path)
+    candidates = fast_cpu_fft2_sizes_batch() if batch else fast_cpu_fft2_sizes_single()
+    candidates = [n for n in candidates if min_size <= n <= max_size]
+
+    rng = np.random.default_rng(0)
+    timings = {}
+    for n in tqdm(candidates, "Autotune FFT sizes"):
+        arr = rng.standard_normal((16, n, n) if batch else (n, n)).astype(np.float32)
+        backend.irfft2_center(backend.rfft2_center(arr)) # warm up, plan
+        times = []
+        for _ in range(num_repeats):
+            time_st = perf_counter()
+            backend.irfft2_center(backend.rfft2_center(arr))
+            times.append(perf_counter() - time_st)
+        timings[n] = min(times)
+
+    fast_sizes = []
+    fastest_larger = np.inf
+    for n in sorted(timings.keys(), reverse=True):
+        if timings[n] < fastest_larger:
+            fast_sizes.append(n)
+            fastest_larger = timings[n]
+    fast_sizes = sorted(fast_sizes)
+
+    autotuned = {}
+    if autotune_path.exists():
+        with open(autotune_path, "r") as f:
+            autotuned = json.load(f)
+    autotuned["fft2_batch" if batch else "fft2_single"] = {
+        "backend": backend.name,
+        "threads": backend.threads,
+        "fast_sizes": fast_sizes,
+        "timings": {str(n): t for n, t in timings.items()},
+    }
+    autotune_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(autotune_path, "w") as f:
+        json.dump(autotuned, f, indent=4)
+    _AUTOTUNED_FFT2_SIZES.pop((str(autotune_path), batch), None)
+    logger.info(f"Autotuned {len(fast_sizes)} fast FFT sizes out of {len(candidates)}, saved to {autotune_path}")
+    return fast_sizes
@@ -0,0 +1,162 @@
+import os
+import struct
+import logging
+import mrcfile
+import numpy as np
+from pydantic import BaseModel
+from pathlib import Path
+from typing import Union
+logger = logging.getLogger()
+
+from .datatype import ImageType
+from .parallel import start_work_ppe
+
+FILEPATH = Union[str, Path]
+
+# ----------------------------------------------------- IMAGE HEADERS
+# Only the headers are read (MRC: 1024 bytes + extended header, TIFF/EER: the IFD chain),
+# pixels are never decoded, so scanning thousands of files takes seconds.
+
+class ImageHeader(BaseModel):
+    path: str=""
+    image_type: ImageType=ImageType.unknown
+    width: int=0
+    height: int=0
+    frame_num: int=0
+    dtype: str="" # numpy dtype string, "eer" for EER electron events
+    pixel_size: float=0 # unit: A, 0 if not in the header
+
+def read_mrc_header(filepath: FILEPATH) -> ImageHeader:
+    """
+    Read the shape, dtype and pixel size of a MRC / MRCS file from its header
+    """
+    with mrcfile.open(filepath, mode='r', permissive=True, header_only=True) as mrc:
+        header = mrc.header
+        try:
+            dtype = mrcfile.utils.data_dtype_from_header(header).newbyteorder("=").str
+        except ValueError:
+            dtype = ""
+        pixel_size = float(mrc.voxel_size.x)
+    return ImageHeader(
+        path=str(filepath),
+        image_type=ImageType.MRCS if str(filepath).lower().endswith(".mrcs") else ImageType.MRC,
+        width=int(header.nx),
+        height=int(header.ny),
+        frame_num=int(header.nz),
+        dtype=dtype,
+        pixel_size=pixel_size,
+    )
+
+TIFF_TAG_IMAGE_WIDTH = 256
+TIFF_TAG_IMAGE_LENGTH = 257
+TIFF_TAG_BITS_PER_SAMPLE = 258
+TIFF_TAG_COMPRESSION = 259
+TIFF_TAG_SAMPLE_FORMAT = 339
+TIFF_TAGS = [TIFF_TAG_IMAGE_WIDTH, TIFF_TAG_IMAGE_LENGTH, TIFF_TAG_BITS_PER_SAMPLE, TIFF_TAG_COMPRESSION, TIFF_TAG_SAMPLE_FORMAT]
+TIFF_FIELD_FORMATS = {1: "B", 3: "H", 4: "I", 6: "b", 8: "h", 9: "i", 16: "Q", 17: "q"}
+TIFF_SAMPLE_FORMAT_KINDS = {1: "u", 2: "i", 3: "f"}
+EER_COMPRESSIONS = [65000, 65001, 65002]
+
+def read_tiff_header(filepath: FILEPATH, max_frame_num: int=100000) -> ImageHeader:
+    """
+    Read the shape and dtype of a (Big)TIFF / EER file from its first IFD,
+    the frame number is the length of the IFD chain
+    """
+    with open(filepath, "rb") as f:
+        head = f.read(16)
+        if head[:2] not in [b"II", b"MM"]:
+            raise ValueError(f"Not a TIFF file, byte order {head[:2]}")
+        byteorder = "<" if head[:2] == b"II" else ">"
+        version = struct.unpack(byteorder + "H", head[2:4])[0]
+        if version == 42: # TIFF
+            offset = struct.unpack(byteorder + "I", head[4:8])[0]
+            count_format, value_count_format, offset_format, entry_size = "H", "I", "I", 12
+        elif version == 43: # BigTIFF
+            offset = struct.unpack(byteorder + "Q", head[8:16])[0]
+            count_format, value_count_format, offset_format, entry_size = "Q", "Q", "Q", 20
+        else:
+            raise ValueError(f"Not a TIFF file, version {version}")
+        count_size = struct.calcsize(count_format)
+        offset_size = struct.calcsize(offset_format)
+
+        tags = {}
+        frame_num = 0
+        visited = set()
+        while offset != 0 and offset not in visited and frame_num < max_frame_num:
+            visited.add(offset)
+            f.seek(offset)
+            entry_num = struct.unpack(byteorder + count_format, f.read(count_size))[0]
+            if frame_num == 0:
+                # only the first IFD is parsed, EM movies have the same shape in all frames
+                entries = f.read(entry_num * entry_size)
+                next_offset = struct.unpack(byteorder + offset_format, f.read(offset_size))[0]
+                for i in range(entry_num):
+                    entry = entries[i*entry_size:(i+1)*entry_size]
+                    tag, field_type = struct.unpack(byteorder + "HH", entry[:4])
+                    if tag not in TIFF_TAGS or field_type not in TIFF_FIELD_FORMATS:
+                        continue
+                    value_format = byteorder + TIFF_FIELD_FORMATS[field_type]
+                    value_count = struct.unpack_from(byteorder + value_count_format, entry, 4)[0]
+                    if value_count * struct.calcsize(value_format) <= offset_size:
+                        tags[tag] = struct.unpack_from(value_format, entry, 4 + offset_size)[0]
+                    else:
+                        # per-sample values are stored out of the entry, only the first one is read
+                        f.seek(struct.unpack_from(byteorder + offset_format, entry, 4 + offset_size)[0])
+                        tags[tag] = struct.unpack(value_format, f.read(struct.calcsize(value_format)))[0]
+                offset = next_offset
+            else:
+                f.seek(entry_num * entry_size, os.SEEK_CUR)
+                offset = struct.unpack(byteorder + offset_format, f.read(offset_size))[0]
+            frame_num += 1
+
+    if tags.get(TIFF_TAG_COMPRESSION, 1) in EER_COMPRESSIONS:
+        image_type, dtype = ImageType.EER, "eer"
+    else:
+        kind = TIFF_SAMPLE_FORMAT_KINDS.get(tags.get(TIFF_TAG_SAMPLE_FORMAT, 1), "u")
+        image_type, dtype = ImageType.TIFF, np.dtype(f"{kind}{tags.get(TIFF_TAG_BITS_PER_SAMPLE, 8) // 8}").str
+    return ImageHeader(
+        path=str(filepath),
+        image_type=image_type,
+        width=int(tags.get(TIFF_TAG_IMAGE_WIDTH, 0)),
+        height=int(tags.get(TIFF_TAG_IMAGE_LENGTH, 0)),
+        frame_num=frame_num,
+        dtype=dtype,
+    )
+
+IMAGE_HEADER_READERS = {
+    ".mrc": read_mrc_header,
+    ".mrcs": read_mrc_header,
+    ".tif": read_tiff_header,
+    ".tiff": read_tiff_header,
+    ".eer": read_tiff_header,
+    ".gain": read_tiff_header, # EPU gain references are TIFF files
+}
+
+def read_image_header(filepath: FILEPATH) -> ImageHeader:
+    """
+    Read the header of an image / gain file by its suffix, None if unsupported or unreadable
+    """
+    suffix = Path(filepath).suffix.lower()
+    if suffix not in IMAGE_HEADER_READERS:
+        logger.debug(f"Unsupported image header {filepath}")
+        return None
+    try:
+        return IMAGE_HEADER_READERS[suffix](filepath)
+    except Exception as e:
+        logger.warning(f"Could not read image header {filepath}: {e}")
+        return None
+
+def scan_image_headers(filepaths: list[FILEPATH], num_workers: int=16, show_tqdm: bool=False) -> list[ImageHeader]:
+    """
+    Read the headers of many image / gain files in parallel, None for unsupported or unreadable files
+    """
+    # a header read is much cheaper than the IPC of a task, so the files are sent in chunks
+    return start_work_ppe(read_image_header, [str(filepath) for filepath in filepaths], num_workers=num_workers, show_tqdm=show_tqdm, chunksize=64)
+
+def scan_image_headers_in_dir(directory: FILEPATH, num_workers: int=16, show_tqdm: bool=False) -> list[ImageHeader]:
+    """
+    Read the headers of all supported image / gain files in a local directory (recursively) in parallel
+    """
+    filepaths = sorted(path for path in Path(directory).rglob("*") if path.is_file() and path.suffix.lower() in IMAGE_HEADER_READERS)
+    headers = scan_image_headers(filepaths, num_workers=num_workers, show_tqdm=show_tqdm)
+    return [header for header in headers if header is not None]
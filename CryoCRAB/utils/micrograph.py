@@ -1,7 +1,8 @@
+import functools
 import numpy as np
-from numba import jit
 from . import fft
 from . import fft_sizes
+from .cache import array_cache, Workspace
 # from .background import do_lowpass_filter_2D_herm_gaussian_core
 
 # ----------------------------------------------------- PADDING AND TRIMMING
@@ -22,6 +23,7 @@ def pad_mic(
     dtype = np.float32, 
     out: np.ndarray = None
 ):
+    stack = arr.ndim == 3 # a (1, Y, X) stack stays a stack
     arr = arr.reshape((-1,)+arr.shape[-2:])
     nz, ny, nx = arr.shape
     if dtype is None: dtype = arr.dtype
@@ -38,49 +40,108 @@ def pad_mic(
     xa, xb = (N//2)-nxa, (N//2)+nxb
     for z in range(nz):
         res[z, ya:yb, xa:xb] = arr[z]
+    val = np.reshape(val, (-1, 1, 1)) # scalar or one value per z
     res[:,:,:xa] = val
     res[:,:,xb:] = val
     res[:,:ya,:] = val
     res[:,yb:,:] = val
-    if nz == 1:
-        return res.reshape(res.shape[-2:])
-    else:
+    if stack:
         return res
+    else:
+        return res.reshape(res.shape[-2:])
     
 def pad_mic_with_mean(
     arr: np.ndarray, 
     N: int = None, 
-    dtype = np.float32
+    dtype = np.float32,
+    out: np.ndarray = None
 ):
-    mean = arr.mean()
-    return pad_mic(arr, N, mean, dtype)
+    mean = arr.mean(axis=(-2, -1)) # one mean per z for stacks
+    return pad_mic(arr, N, mean, dtype, out)
 
 def pad_mic_with_zero(
     arr: np.ndarray, 
     N = None,
-    dtype = np.float32
+    dtype = np.float32,
+    out: np.ndarray = None
+):
+    return pad_mic(arr, N, 0, dtype, out)
+
+def get_workspace_buffer(
+    workspace: Workspace, 
+    name: str, 
+    shape: tuple, 
+    dtype
 ):
-    return pad_mic(arr, N, 0, dtype)
+    """
+    Get a reusable buffer from the workspace, None (allocate) without workspace
+    """
+    if workspace is None:
+        return None
+    return workspace.get(name, shape, dtype)
 
 def trim_mic(
     arr: np.ndarray, 
     shape: tuple
 ):
-    Ny, Nx = arr.shape
-    ny, nx = shape
+    # arr can be (..., Ny, Nx), e.g. a (Z, Y, X) stack, shape is (ny, nx)
+    Ny, Nx = arr.shape[-2:]
+    ny, nx = shape[-2:]
     nya = (ny//2)
     nyb = ny-nya
     nxa = (nx//2)
     nxb = nx-nxa
     ya, yb = (Ny//2)-nya, (Ny//2)+nyb
     xa, xb = (Nx//2)-nxa, (Nx//2)+nxb
-    return arr[ya:yb, xa:xb]
+    return arr[..., ya:yb, xa:xb]
+
+def get_tiles(
+    arr: np.ndarray, 
+    tile_size: int
+):
+    """
+    Copy a micrograph into flattened tile_size * tile_size tiles, as (num_tiles, num_pixels) arrays
+    grouped by tile shape since the tiles at the bottom and right edges are smaller
+    """
+    ny, nx = arr.shape
+    ny_full, nx_full = ny - ny % tile_size, nx - nx % tile_size
+    tile_groups = []
+    for ya, yb in [(0, ny_full), (ny_full, ny)]:
+        for xa, xb in [(0, nx_full), (nx_full, nx)]:
+            if yb <= ya or xb <= xa:
+                continue
+            tile_y, tile_x = min(tile_size, yb-ya), min(tile_size, xb-xa)
+            num_y, num_x = (yb-ya) // tile_y, (xb-xa) // tile_x
+            tiles = np.empty((num_y*num_x, tile_y*tile_x), dtype=arr.dtype)
+            tiles.reshape(num_y, num_x, tile_y, tile_x)[...] = arr[ya:yb, xa:xb].reshape(num_y, tile_y, num_x, tile_x).transpose(0, 2, 1, 3)
+            tile_groups.append(tiles)
+    return tile_groups
+
+def get_tiles_percentile_inplace(
+    tiles: np.ndarray, 
+    q: float
+):
+    """
+    Get the q-th percentile of every tile (linear interpolation as np.percentile) with one
+    partition of all tiles, reorders the tiles. Tiles containing NaN give NaN.
+    """
+    n = tiles.shape[1]
+    pos = q / 100.0 * (n - 1)
+    k = int(np.floor(pos))
+    frac = pos - k
+    tiles.partition(k, axis=1) # NaN are partitioned to the end
+    val = tiles[:, k].copy()
+    if frac > 0:
+        # after the partition the next order statistic is the minimum of the upper part
+        val_next = tiles[:, k+1:].min(axis=1)
+        val += (val_next - val) * frac
+    return val
 
-@jit
 def contrast_normalization(
     arr_bin: np.ndarray, 
     tile_size: int = 128, 
-    extend: float = 1.5
+    extend: float = 1.5,
+    subsample: int = 1,
 ):
     '''
     Computes the minimum and maximum contrast values to use when
@@ -92,32 +153,29 @@ def contrast_normalization(
     :param tile_size: the size of the patch to split the mic by 
         (larger is faster)
     :type tile_size: int
+    :param subsample: only use every subsample-th pixel along y and x
+        of a patch (larger is faster, 1 is exact)
+    :type subsample: int
     '''
-    ny,nx = arr_bin.shape
-    # set up start and end indexes to make looping code readable
-    tile_start_x = np.arange(0, nx, tile_size)
-    tile_end_x = tile_start_x + tile_size
-    tile_start_y = np.arange(0, ny, tile_size)
-    tile_end_y = tile_start_y + tile_size
-    num_tile_x = len(tile_start_x)
-    num_tile_y = len(tile_start_y)
-    
-    # initialize array that will hold means and std devs of all patches
-    tile_all_data = np.empty((num_tile_y*num_tile_x, 2), dtype=np.float32)
-
-    index = 0
-    for y in range(num_tile_y):
-        for x in range(num_tile_x):
-            # cut out a patch of the mic
-            arr_tile = arr_bin[tile_start_y[y]:tile_end_y[y], tile_start_x[x]:tile_end_x[x]]
-            # store 2nd and 98th percentile values
-            tile_all_data[index:,0] = np.percentile(arr_tile, 98)
-            tile_all_data[index:,1] = np.percentile(arr_tile, 2)
-            index += 1
+    arr_bin = np.asarray(arr_bin)
+    if not np.issubdtype(arr_bin.dtype, np.floating):
+        arr_bin = arr_bin.astype(np.float32)
+    if subsample > 1:
+        arr_bin = arr_bin[::subsample, ::subsample]
+        tile_size = max(1, tile_size // subsample)
+
+    # store 98th and 2nd percentile values of all patches
+    tile_all_data = []
+    for tiles in get_tiles(arr_bin, tile_size):
+        tile_98 = get_tiles_percentile_inplace(tiles, 98)
+        tile_2 = get_tiles_percentile_inplace(tiles, 2)
+        tile_2[np.isnan(tile_98)] = np.nan # NaN tiles can have a finite lower percentile
+        tile_all_data.append(np.stack([tile_98, tile_2], axis=1))
+    tile_all_data = np.concatenate(tile_all_data).astype(np.float32)
 
     # calc median of non-NaN percentile values
-    all_tiles_98_median = np.nanmedian(tile_all_data[:,0])
-    all_tiles_2_median = np.nanmedian(tile_all_data[:,1])
+    all_tiles_98_median = float(np.nanmedian(tile_all_data[:,0]))
+    all_tiles_2_median = float(np.nanmedian(tile_all_data[:,1]))
     vmid = 0.5*(all_tiles_2_median+all_tiles_98_median)
     vrange = abs(all_tiles_2_median-all_tiles_98_median)
     # extend vmin and vmax enough to not include outliers
@@ -159,66 +217,92 @@ def show_array(
     )
     return arr_bin
 
-def do_lowpass_filter_2D_herm_gaussian_core(
-    farr: np.ndarray, 
-    frame_shape: tuple, # extra input reason: since this is the shape of micrograph not its FT
+@array_cache
+def get_lowpass_filter_2D_herm_gaussian(
+    frame_shape: tuple,
     one_over_sigma_fspace2: float,
+    dtype = None,
 ):
     # one_over_sigma2 is of gaussian in fourier space 
     # one_over_sigma_fspace**2 = pi^2 * sigma_real^2 in terms of the sigma in real space
-    ny, nx = farr.shape
-    freqs = fft.get_rfft_center_freqs(frame_shape, psize_A=1.0)
+    freqs = fft.get_rfft_center_freqs(frame_shape, psize_A=1.0, dtype=dtype)
     freqs_y = freqs[..., 0] * frame_shape[0] # unit: 1
     freqs_x = freqs[..., 1] * frame_shape[1] # unit: 1
     freqs_norm2 = freqs_y**2 + freqs_x**2
-    filt = np.exp(- freqs_norm2 * 0.5 * one_over_sigma_fspace2)
-    farr *= filt
+    filt = np.exp(- freqs_norm2 * 0.5 * one_over_sigma_fspace2).astype(freqs.dtype, copy=False)
     # zero nyquist at the end
-    farr[0, :] = 0.0
-    farr[-1, :] = 0.0
-    farr[:, -1] = 0.0
+    filt[0, :] = 0.0
+    filt[-1, :] = 0.0
+    filt[:, -1] = 0.0
+    return filt
+
+def do_lowpass_filter_2D_herm_gaussian_core(
+    farr: np.ndarray, 
+    frame_shape: tuple, # extra input reason: since this is the shape of micrograph not its FT
+    one_over_sigma_fspace2: float,
+):
+    farr *= get_lowpass_filter_2D_herm_gaussian(frame_shape, one_over_sigma_fspace2, farr.real.dtype)
     return farr
 
-def estimate_background(
+def do_zeropad_lowpass_crop(
     arr: np.ndarray, 
     fwhm: float, 
-    out_N: int = None
+    out_shape: tuple,
+    workspace: Workspace = None,
 ):
-    """ 
-    arr should be ny x nx (not padded, but binned because it will get zeropadded to 2N) 
-    fwhm should be in fraction of N, like 0.1
+    """
+    Zeropad arr to 2N, lowpass it with a gaussian of fwhm (fraction of N) and crop it to out_shape.
+    Always in double precision: the gaussian tails underflow in float32, which breaks the edge normalization.
     """
     sigma_real2 = (2*fwhm/2.3548)**2
     one_over_sigma_fspace2 = np.pi**2 * sigma_real2
-    # assume that arr is already binned down to a reasonable size
-    # assert ny == nx
-    # assert np.log2(ny).is_integer()
     N = get_lowest_pow_2(arr.shape)
     N_zp = 2 * N 
-    if out_N is not None: out_shape = (out_N, out_N)
-    else: out_shape = arr.shape
-    
-    do_zeropad_rfft_filt = lambda x: do_lowpass_filter_2D_herm_gaussian_core(
+    farr_zp = do_lowpass_filter_2D_herm_gaussian_core(
         farr=fft.rfft2_center( 
-            pad_mic_with_zero( arr=x, N=N_zp ) 
+            pad_mic_with_zero( arr=arr, N=N_zp, out=get_workspace_buffer(workspace, "estimate_background.pad", (N_zp, N_zp), np.float32) ), 
+            dtype=np.float64,
         ),
         frame_shape=(N_zp, N_zp),
         one_over_sigma_fspace2=one_over_sigma_fspace2,
-    )    
-    do_irfft_crop = lambda x: trim_mic(
-        arr=fft.irfft2_center( x ), 
+    )
+    return trim_mic(
+        arr=fft.irfft2_center( farr_zp ), 
         shape=out_shape
     )
+
+@array_cache
+def get_background_edge_normalization(
+    frame_shape: tuple, 
+    fwhm: float, 
+    out_shape: tuple,
+):
+    """
+    Lowpassed zeropadded ones, which normalizes the edges of a lowpassed zeropadded array.
+    It only depends on (frame_shape, fwhm, out_shape), so it is computed once per geometry.
+    """
+    return do_zeropad_lowpass_crop(np.ones(frame_shape, np.float32), fwhm, out_shape).copy()
+
+def estimate_background(
+    arr: np.ndarray, 
+    fwhm: float, 
+    out_N: int = None,
+    workspace: Workspace = None,
+):
+    """ 
+    arr should be ny x nx (not padded, but binned because it will get zeropadded to 2N) 
+    fwhm should be in fraction of N, like 0.1
+    """
+    # assume that arr is already binned down to a reasonable size
+    # assert ny == nx
+    # assert np.log2(ny).is_integer()
+    if out_N is not None: out_shape = (out_N, out_N)
+    else: out_shape = arr.shape
     
-    farr_zp = do_zeropad_rfft_filt(arr)
-    # now farr_zp is the lowpass version of the zeropadded array. 
+    # now arr_zp_lp_cp is the lowpass version of the zeropadded array. 
     # only now the edges need to be taken care of.
-    fones_zp = do_zeropad_rfft_filt(
-        np.ones(arr.shape, np.float32)
-    )
-    
-    arr_zp_lp_cp = do_irfft_crop(farr_zp)
-    ones_zp_lp_cp = do_irfft_crop(fones_zp)
+    arr_zp_lp_cp = do_zeropad_lowpass_crop(arr, fwhm, out_shape, workspace)
+    ones_zp_lp_cp = get_background_edge_normalization(arr.shape, fwhm, out_shape)
 
     return arr_zp_lp_cp / ones_zp_lp_cp
 
@@ -226,75 +310,101 @@ def bin_mic(
     arr: np.ndarray, 
     bin_factor: float = None,
     frame_shape_out: tuple = None,
+    workspace: Workspace = None,
 ):
+    """
+    Fourier crop a micrograph (Y, X), or a stack of same-sized micrographs (Z, Y, X) with batched FFTs.
+    The padded micrograph and the cropped transform reuse the buffers of workspace if given.
+    """
     assert bin_factor is not None or frame_shape_out is not None, "Please provide bin_factor or frame_shaoe_out at least!"
     
-    frame_shape_in = arr.shape
+    stack = arr.ndim == 3
+    frame_shape_in = arr.shape[-2:]
     
     if bin_factor is not None:
         # since we do not consider soft mask on the boundary of freqs, we only can handle downsample here
         assert bin_factor >= 1, "Only support bin_factor > 1 here, if you want to upsample, please use upsample_mic instead"
         frame_shape_out = [int(x / bin_factor) for x in frame_shape_in]
+    else:
+        bin_factor = max(frame_shape_in) / max(frame_shape_out)
     
     N_in = fft_sizes.get_lowest_fast_size(frame_shape_in)
     N_out = fft_sizes.get_lowest_fast_size(N_in / bin_factor)
     
-    do_meanpad_rfft_crop = lambda x: fft.ZT(
-        x=fft.rfft2_center(
-          pad_mic_with_mean( arr=x,  N=N_in, )  
-        ),
+    stack_shape = arr.shape[:-2]
+    
+    # meanpad, rfft, crop
+    arr_ft = fft.rfft2_center(
+        pad_mic_with_mean( arr=arr,  N=N_in, out=get_workspace_buffer(workspace, "bin_mic.pad", stack_shape+(N_in, N_in), np.float32) )
+    )
+    arr_ft = fft.ZT(
+        x=arr_ft,
         M=N_out,
+        stack=stack,
+        res=get_workspace_buffer(workspace, "bin_mic.ft", stack_shape+(N_out, N_out//2+1), arr_ft.dtype),
     )
-    do_irfft_trim = lambda x: trim_mic(
-        arr=fft.irfft2_center(x),
+    # irfft, trim
+    arr = trim_mic(
+        arr=fft.irfft2_center(arr_ft),
         shape=frame_shape_out
     )
     
-    arr_ft = do_meanpad_rfft_crop(arr)
-    arr = do_irfft_trim(arr_ft)
-    
     return arr
 
 def upsample_mic(
     arr: np.array,
     upsample_factor: float = None,
     frame_shape_out: tuple = None,
+    workspace: Workspace = None,
 ):
+    """
+    Fourier upsample a micrograph (Y, X), or a stack of same-sized micrographs (Z, Y, X) with batched FFTs.
+    The padded micrograph and the zeropadded transform reuse the buffers of workspace if given.
+    """
     assert upsample_factor is not None or frame_shape_out is not None, "Please provide upsample_factor or frame_shaoe_out at least!"
     
-    frame_shape_in = arr.shape
+    stack = arr.ndim == 3
+    frame_shape_in = arr.shape[-2:]
     
     if upsample_factor is not None:
         # since we do not consider soft mask on the boundary of freqs, we only can handle downsample here
         assert upsample_factor >= 1, "Only support upsample_factor > 1 here, if you want to downsample, please use bin_mic instead"
         frame_shape_out = [int(x * upsample_factor) for x in frame_shape_in]
+    else:
+        upsample_factor = max(frame_shape_out) / max(frame_shape_in)
         
     N_in = fft_sizes.get_lowest_fast_size(frame_shape_in)
     N_out = fft_sizes.get_lowest_fast_size(N_in * upsample_factor)
     
-    do_meanpad_rfft_zeropad_softmask = lambda x: fft.ZT( # zeropad
-        x=fft.rfft2_center(  # rfft
-            pad_mic_with_mean( arr=x,  N=N_in, ) # meanpad
-        ),
+    stack_shape = arr.shape[:-2]
+    
+    # meanpad, rfft, zeropad, softmask
+    arr_ft = fft.rfft2_center(
+        pad_mic_with_mean( arr=arr,  N=N_in, out=get_workspace_buffer(workspace, "upsample_mic.pad", stack_shape+(N_in, N_in), np.float32) )
+    )
+    arr_ft = fft.ZT(
+        x=arr_ft,
         M=N_out,
-    ) * fft.get_upsample_softmask( # softmask
+        stack=stack,
+        res=get_workspace_buffer(workspace, "upsample_mic.ft", stack_shape+(N_out, N_out//2+1), arr_ft.dtype),
+    )
+    arr_ft *= fft.get_upsample_softmask(
         frame_shape_in=(N_in, N_in),
         frame_shape_out=(N_out, N_out),
     )
-    do_irfft_trim = lambda x: trim_mic(
-        arr=fft.irfft2_center(x),
+    # irfft, trim
+    arr = trim_mic(
+        arr=fft.irfft2_center(arr_ft),
         shape=frame_shape_out
     )
     
-    arr_ft = do_meanpad_rfft_zeropad_softmask(arr)
-    arr = do_irfft_trim(arr_ft)
-    
     return arr
         
 
 def estimate_subtract_background(
     mic_gc: np.ndarray, 
     psize: float,
+    workspace: Workspace = None,
 ):
     """
     Estimate the background and subtract it from a gain corrected micrograph
@@ -303,36 +413,237 @@ def estimate_subtract_background(
     :type mic_gc: 2D array
     :param psize: the pixel size of the micrograph
     :type psize: float
+    :param workspace: reusable buffers, e.g. cache.get_workspace() in a worker process
+    :type workspace: Workspace
     """
     frame_shape = mic_gc.shape
     N = get_lowest_pow_2(frame_shape)
-    bg_binfactor = int(np.ceil(N / 1024.0))
-    mic_bin = bin_mic(mic_gc, bg_binfactor)
+    N_in = fft_sizes.get_lowest_fast_size(frame_shape) # the padded size of bin_mic
+    bg_binfactor, N_bg, _, bg_scale = get_background_geometry(frame_shape, N_in)
+    mic_bin = bin_mic(mic_gc, bg_binfactor, workspace=workspace)
     # "full width half max" - a parameterization of gaussians used for smoothing
     fwhm = (200 / psize) / N
     # this is a padded 1024x1024 bg size
-    bg_bin = estimate_background(mic_bin, fwhm, out_N=1024)
-    bg_full = upsample_mic(
-        arr=bg_bin,
-        upsample_factor=bg_binfactor
+    bg_bin = estimate_background(mic_bin, fwhm, out_N=1024, workspace=workspace)
+    # now final bg_full of summed movie, resampled at the exact ratio of the binning
+    bg_full = interpolate_background(
+        bg_bin * bg_scale, frame_shape, N_in, N_bg,
+        out=get_workspace_buffer(workspace, "estimate_subtract_background.bg", frame_shape, fft.get_real_dtype()),
     )
-    # now final bg_full of summed movie
-    bg_full = trim_mic(bg_full, frame_shape).copy()
     mic_bg_sub = mic_gc - bg_full
     return mic_bg_sub
 
 def background_addition(
     mic_gc_noBG: np.ndarray, 
     bg_bin: np.ndarray,
+    workspace: Workspace = None,
 ):
     frame_shape = mic_gc_noBG.shape
-    N = get_lowest_pow_2(frame_shape)
-    bg_binfactor = int(np.ceil(N / 1024.0))
-    bg_full = upsample_mic(
-        arr=bg_bin,
-        upsample_factor=bg_binfactor
-    )
+    N_in = fft_sizes.get_lowest_fast_size(frame_shape)
+    _, N_bg, _, bg_scale = get_background_geometry(frame_shape, N_in)
     # now final bg_full of summed movie
-    bg_full = trim_mic(bg_full, frame_shape).copy()
+    bg_full = interpolate_background(
+        bg_bin * bg_scale, frame_shape, N_in, N_bg,
+        out=get_workspace_buffer(workspace, "background_addition.bg", frame_shape, fft.get_real_dtype()),
+    )
     mic_bg_add = mic_gc_noBG + bg_full
     return mic_bg_add
+
+# ----------------------------------------------------- FUSED PREPROCESSING
+
+def get_background_geometry(
+    frame_shape: tuple, 
+    N_in: int,
+):
+    """
+    Get the bin factor, padded size and shape of the binned micrograph the background is estimated on
+    (as bin_mic of a micrograph meanpadded to N_in), and the scale of the background.
+    A binned pixel is N_in / N_bg micrograph pixels, which is bg_binfactor only if N_in / bg_binfactor is a fast size,
+    so the background is resampled at N_in / N_bg and scaled by (N_bg / N_in)**2 to undo the gain of the Fourier crop.
+    """
+    N = get_lowest_pow_2(frame_shape)
+    bg_binfactor = int(np.ceil(N / 1024.0))
+    N_bg = fft_sizes.get_lowest_fast_size(N_in / bg_binfactor)
+    frame_shape_bg = tuple(int(x / bg_binfactor) for x in frame_shape)
+    bg_scale = (N_bg / N_in)**2
+    return bg_binfactor, N_bg, frame_shape_bg, bg_scale
+
+@functools.lru_cache(maxsize=32)
+def get_background_interpolation(
+    n: int, 
+    N: int, 
+    N_bg: int, 
+    n_bg: int = 1024,
+):
+    """
+    Get the indices and weights (n, 4) of the cubic convolution interpolation of the n_bg background 
+    of estimate_background, binned from N to N_bg, at the n pixels along one axis of the micrograph
+    """
+    # bin_mic and estimate_background both keep the center N//2 of the padded micrographs
+    coords = n_bg//2 - N_bg/2 + (np.arange(n) + N//2 - n//2) * (N_bg / N)
+    idx0 = np.floor(coords).astype(int)
+    t = (coords - idx0)[:, None]
+    idx = np.clip(idx0[:, None] + np.arange(-1, 3)[None, :], 0, n_bg-1)
+    # Keys cubic convolution (a = -0.5)
+    weights = np.concatenate([
+        ((-0.5*t + 1.0)*t - 0.5)*t,
+        (1.5*t - 2.5)*t*t + 1.0,
+        ((-1.5*t + 2.0)*t + 0.5)*t,
+        (0.5*t - 0.5)*t*t,
+    ], axis=1)
+    idx.flags.writeable = False
+    weights.flags.writeable = False
+    return idx, weights
+
+def interpolate_background(
+    bg_bin: np.ndarray, 
+    frame_shape: tuple, 
+    N_in: int, 
+    N_bg: int,
+    out: np.ndarray = None,
+):
+    """
+    Resample the background of estimate_background, binned from N_in to N_bg, at the pixels of the micrograph,
+    into out if given (e.g. a workspace buffer)
+    """
+    ny, nx = frame_shape
+    idx_y, weights_y = get_background_interpolation(ny, N_in, N_bg, bg_bin.shape[0])
+    idx_x, weights_x = get_background_interpolation(nx, N_in, N_bg, bg_bin.shape[1])
+    bg_y = sum(weights_y[:, [i]] * bg_bin[idx_y[:, i]] for i in range(4)) # (ny, n_bg)
+    if out is None:
+        bg_full = np.zeros(frame_shape, fft.get_real_dtype())
+    else:
+        bg_full = out
+        bg_full.fill(0)
+    for i in range(4):
+        bg_full += weights_x[:, i] * bg_y[:, idx_x[:, i]]
+    return bg_full
+
+def get_padded_ft_1D(
+    arr: np.ndarray, 
+    N: int, 
+    N_out: int, 
+    rfft: bool = False,
+):
+    """
+    1D transforms of the rows of arr padded to N and Fourier cropped to N_out, along one axis 
+    as in ZT(rfft2_center(pad_mic(...)), N_out): centered fft along y, rfft along x
+    """
+    n = arr.shape[-1]
+    arr_pad = np.zeros(arr.shape[:-1] + (N,), np.float64)
+    arr_pad[..., N//2-n//2:N//2-n//2+n] = arr
+    Q = min(N, N_out)
+    if rfft:
+        res = np.zeros(arr.shape[:-1] + (N_out//2+1,), np.complex128)
+        res[..., :Q//2] = np.fft.rfft(arr_pad)[..., :Q//2]
+    else:
+        BM, BN = (N_out-Q)//2, (N-Q)//2
+        res = np.zeros(arr.shape[:-1] + (N_out,), np.complex128)
+        res[..., BM+1:BM+Q] = np.fft.fftshift(np.fft.fft(arr_pad), axes=-1)[..., BN+1:BN+Q]
+    return res
+
+def estimate_background_ft(
+    mic_ft: np.ndarray, 
+    frame_shape: tuple, 
+    psize: float,
+    N_out: int,
+    workspace: Workspace = None,
+    rtol: float = 1e-7,
+):
+    """
+    Estimate the background of a micrograph from its centered rfft mic_ft (meanpadded to N_in), 
+    returned as ZT(rfft2_center(pad_mic_with_mean(bg_full, N_in)), N_out) for the background bg_full 
+    of estimate_subtract_background, so that it can be subtracted from the Fourier crop of mic_ft.
+
+    The background is estimated on the binned micrograph as in estimate_subtract_background. 
+    It is smooth, so it is interpolated at the micrograph pixels from a low rank (SVD, singular values 
+    above rtol) separable approximation, and its padded transform is a sum of outer products of 1D 
+    transforms. The background is never materialized at the size of the micrograph.
+
+    :param mic_ft: the centered rfft of the micrograph meanpadded to N_in
+    :type mic_ft: 2D complex array
+    :param frame_shape: the shape of the micrograph
+    :type frame_shape: tuple
+    :param psize: the pixel size of the micrograph
+    :type psize: float
+    :param N_out: the padded size of the output
+    :type N_out: int
+    """
+    N_in = mic_ft.shape[-2]
+    ny, nx = frame_shape
+    N = get_lowest_pow_2(frame_shape)
+    bg_binfactor, N_bg, frame_shape_bg, bg_scale = get_background_geometry(frame_shape, N_in)
+    # binned micrograph from the same transform, as bin_mic
+    mic_bin_ft = fft.ZT(
+        x=mic_ft, 
+        M=N_bg, 
+        res=get_workspace_buffer(workspace, "estimate_background_ft.bin_ft", (N_bg, N_bg//2+1), mic_ft.dtype),
+    )
+    mic_bin = trim_mic(fft.irfft2_center(mic_bin_ft), frame_shape_bg)
+    # "full width half max" - a parameterization of gaussians used for smoothing
+    fwhm = (200 / psize) / N
+    # this is a padded 1024x1024 bg size, on the scale of the binned micrograph
+    bg_bin = estimate_background(mic_bin, fwhm, out_N=1024, workspace=workspace)
+    bg_bin = bg_bin * bg_scale
+
+    # low rank approximation of the part of bg_bin interpolated at the micrograph pixels
+    idx_y, weights_y = get_background_interpolation(ny, N_in, N_bg)
+    idx_x, weights_x = get_background_interpolation(nx, N_in, N_bg)
+    ya, yb, xa, xb = idx_y.min(), idx_y.max()+1, idx_x.min(), idx_x.max()+1
+    U, S, Vh = np.linalg.svd(bg_bin[ya:yb, xa:xb], full_matrices=False)
+    rank = max(1, int(np.sum(S > rtol * S[0])))
+    U, S, Vh = U[:, :rank], S[:rank], Vh[:rank]
+    bg_y = sum(weights_y[:, [i]] * U[idx_y[:, i]-ya] for i in range(4)).T # (rank, ny)
+    bg_x = sum(weights_x[:, [i]] * Vh.T[idx_x[:, i]-xa] for i in range(4)).T # (rank, nx)
+    # pad_mic_with_mean(bg_full) = mean + frame mask * (bg_full - mean), where the frame mask is separable as well
+    bg_mean = np.sum(S * bg_y.mean(axis=1) * bg_x.mean(axis=1))
+    bg_y = np.concatenate([bg_y, np.ones((1, ny))])
+    bg_x = np.concatenate([bg_x * S[:, None], -bg_mean * np.ones((1, nx))])
+    bg_ft = get_padded_ft_1D(bg_y, N_in, N_out).T @ get_padded_ft_1D(bg_x, N_in, N_out, rfft=True)
+    bg_ft[N_out//2, 0] += bg_mean * N_in**2
+    return bg_ft.astype(mic_ft.dtype, copy=False)
+
+def preprocess_micrograph(
+    mic_gc: np.ndarray, 
+    psize: float,
+    desired_psize_A: float = 3.0,
+    ctffilt: np.ndarray = None,
+    subtract_background: bool = True,
+    workspace: Workspace = None,
+):
+    """
+    Subtract the background, Fourier crop to desired_psize_A and CTF filter a gain corrected micrograph,
+    with one forward FFT at the input size and one inverse FFT at the output size.
+    Same as estimate_subtract_background followed by bin_mic and the CTF filter, but the background 
+    is subtracted in Fourier space at the output size.
+
+    :param mic_gc: the gain corrected micrograph
+    :type mic_gc: 2D array
+    :param psize: the pixel size of the micrograph
+    :type psize: float
+    :param desired_psize_A: the desired output pixel size
+    :type desired_psize_A: float
+    :param ctffilt: the CTF filter of the output geometry (N_out, N_out//2+1), e.g. from compute_ctf
+    :type ctffilt: 2D array
+    :return: the preprocessed micrograph and its pixel size
+    """
+    frame_shape_in = mic_gc.shape
+    N_in, N_out, psize_out, _, frame_shape_out = fft_sizes.get_shapes_for_desired_psize(psize, frame_shape_in, desired_psize_A)
+    
+    mic_ft = fft.rfft2_center(
+        pad_mic_with_mean(arr=mic_gc, N=N_in, out=get_workspace_buffer(workspace, "preprocess_micrograph.pad", (N_in, N_in), np.float32))
+    )
+    mic_out_ft = fft.ZT(
+        x=mic_ft, 
+        M=N_out, 
+        res=get_workspace_buffer(workspace, "preprocess_micrograph.ft", (N_out, N_out//2+1), mic_ft.dtype),
+    )
+    if subtract_background:
+        mic_out_ft -= estimate_background_ft(mic_ft, frame_shape_in, psize, N_out, workspace)
+    if ctffilt is not None:
+        mic_out_ft *= ctffilt
+    mic_out = trim_mic(
+        arr=fft.irfft2_center(mic_out_ft),
+        shape=frame_shape_out
+    )
+    return mic_out, psize_out
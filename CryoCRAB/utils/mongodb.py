@@ -1,5 +1,7 @@
 import os
 import enum 
+import asyncio
+import weakref
 import logging 
 import numpy as np
 from pydantic import BaseModel
@@ -8,6 +10,7 @@ from pymongo.collection import Collection
 from motor.motor_asyncio import AsyncIOMotorClient
 
 from .datatype import *
+from .dataset_stats import get_total_image_num
 
 logger = logging.getLogger()
 
@@ -23,16 +26,59 @@ def get_mongo_client_info():
         exit()
     return CRYOCRAB_MONGODB_HOST, int(CRYOCRAB_MONGODB_PORT), CRYOCRAB_MONGODB_DBNAME
 
-def get_dataset(collection_name: str, async_motor=False):
+# One client (i.e. one connection pool) per process and server, shared by all the collection getters.
+# Clients connect lazily on the first operation and are never reused after fork, the child creates its own.
+MONGO_CLIENTS = {}
+# Motor clients are bound to the event loop they run on, so they are kept per running loop
+MOTOR_CLIENTS = weakref.WeakKeyDictionary()
+
+def clear_mongo_clients_after_fork():
+    # the parent's clients (sockets, monitor threads) are unusable in the child, drop them without closing
+    MONGO_CLIENTS.clear()
+    MOTOR_CLIENTS.clear()
+
+os.register_at_fork(after_in_child=clear_mongo_clients_after_fork)
+
+def get_mongo_pool_size():
+    return int(os.getenv("CRYOCRAB_MONGODB_POOL_SIZE", 10))
+
+def get_mongo_client(async_motor=False):
     """
-    Get the dataset
+    Get the MongoDB client of this process, created on first use.
+    A motor client outside a running event loop is not kept.
     """
     host, port, dbname = get_mongo_client_info()
     if not async_motor:
-        return MongoClient(host, port)[dbname][collection_name]
-    else:
-        client = AsyncIOMotorClient(f"mongodb://{host}:{port}")
-        return client[dbname][collection_name]
+        if (host, port) not in MONGO_CLIENTS:
+            MONGO_CLIENTS[(host, port)] = MongoClient(host, port, maxPoolSize=get_mongo_pool_size(), connect=False)
+        return MONGO_CLIENTS[(host, port)]
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return AsyncIOMotorClient(f"mongodb://{host}:{port}", maxPoolSize=get_mongo_pool_size())
+    loop_clients = MOTOR_CLIENTS.setdefault(loop, {})
+    if (host, port) not in loop_clients:
+        loop_clients[(host, port)] = AsyncIOMotorClient(f"mongodb://{host}:{port}", maxPoolSize=get_mongo_pool_size())
+    return loop_clients[(host, port)]
+
+def close_mongo_clients():
+    """
+    Close all the clients of this process
+    """
+    for client in MONGO_CLIENTS.values():
+        client.close()
+    for loop_clients in MOTOR_CLIENTS.values():
+        for client in loop_clients.values():
+            client.close()
+    MONGO_CLIENTS.clear()
+    MOTOR_CLIENTS.clear()
+
+def get_dataset(collection_name: str, async_motor=False):
+    """
+    Get the dataset
+    """
+    _, _, dbname = get_mongo_client_info()
+    return get_mongo_client(async_motor=async_motor)[dbname][collection_name]
 
 def get_empiar_dataset(async_motor=False):
     """
@@ -57,11 +103,8 @@ def get_total_image_num_given_dataset(collection: Collection, image_max_num=np.i
     """
     Get the total image number
     """
-    # sum the image_num 
-    total_image_num = 0
-    for doc in collection.find({}, {"image_num": 1}):
-        total_image_num += min(doc["image_num"], image_max_num)
-    return total_image_num
+    # summed by the server, see dataset_stats
+    return get_total_image_num(collection, image_max_num=image_max_num)
 
 def update_dataset_col_with_docs(col: Collection, docs: list[DatasetDocument]):
     """
@@ -74,6 +117,15 @@ def update_dataset_col_with_docs(col: Collection, docs: list[DatasetDocument]):
         update_ops.append(UpdateOne({"imageset_name": doc.imageset_name}, {"$set": doc_json}, upsert=True))
     col.bulk_write(update_ops)
 
+def update_dataset_col_with_values(col: Collection, imageset_values: dict[str, dict]):
+    """
+    Update fields of existing documents of the dataset collection in one bulk write, {imageset_name: {field: value}}
+    """
+    update_ops = [UpdateOne({"imageset_name": imageset_name}, {"$set": values}) for imageset_name, values in imageset_values.items() if len(values) > 0]
+    if len(update_ops) == 0:
+        return 0
+    return col.bulk_write(update_ops, ordered=False).modified_count
+
 def micrograph_dataset_filter(
     determination_method: DeterminationMethod, 
     image_category: ImageCategory,    
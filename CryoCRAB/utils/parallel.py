@@ -5,8 +5,14 @@
 # NOTE: it may make sense to port this to C for parallelization if ProcessPoolExecutor is troublesome
 
 from concurrent.futures.process import ProcessPoolExecutor
-import os, signal, time, threading, sys
+from concurrent.futures import wait, FIRST_COMPLETED
+from multiprocessing import shared_memory, resource_tracker
+import os, signal, time, threading, sys, traceback, logging
+import numpy as np
+from pathlib import Path
+from pydantic import BaseModel
 from tqdm import tqdm 
+logger = logging.getLogger()
 
 def start_thread_to_terminate_when_parent_process_dies(ppid):
     pid = os.getpid()
@@ -20,34 +26,351 @@ def start_thread_to_terminate_when_parent_process_dies(ppid):
     thread = threading.Thread(target=parent_watch, daemon=True)
     thread.start()
 
-def start_work_ppe(workfn, items, num_workers=8, show_tqdm=False, **kwargs):
-    PPE = SafePPE(num_workers=num_workers)
-    res = PPE.do_work(workfn, items,show_tqdm=show_tqdm, **kwargs)
+# long-lived per-process resources built once by the worker initializer, e.g. DB clients, FFT plans
+WORKER_STATE = {}
+
+def get_worker_state(key, default=None):
+    return WORKER_STATE.get(key, default)
+
+def set_worker_state(key, value):
+    WORKER_STATE[key] = value
+
+##################### Shared memory arrays
+# A SharedArray is pickled as (name, shape, dtype), so passing it to or returning it from a worker
+# only sends its handle and the other process maps the same buffer, instead of pickling the array.
+# The creating process owns the segment and unlinks it when the handle is released / garbage collected,
+# a SharedArray returned by a worker is handed over to the parent by do_work / iter_work.
+# Segments of workers killed by the parent watchdog are unlinked by their SIGTERM handler, and
+# the multiprocessing resource tracker unlinks whatever is left when the pool goes away.
+
+SHARED_ARRAY_NAMES_CREATED = set() # segments created by this process in its current task, unlinked on SIGTERM
+
+class SharedArray:
+    """
+    Numpy array in shared memory, SharedArray(shape, dtype) creates a new one, SharedArray(shape, dtype, name) attaches to it
+    """
+    def __init__(self, shape, dtype=np.float32, name=None):
+        self.shape = tuple(int(x) for x in shape)
+        self.dtype = np.dtype(dtype)
+        if name is None:
+            nbytes = max(int(np.prod(self.shape)) * self.dtype.itemsize, 1)
+            self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+            self.owner = True
+            SHARED_ARRAY_NAMES_CREATED.add(self.shm.name)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.name = self.shm.name
+        self.array = np.ndarray(self.shape, self.dtype, buffer=self.shm.buf)
+
+    @classmethod
+    def from_array(cls, arr: np.ndarray):
+        """
+        Copy an array into a new SharedArray
+        """
+        shared_arr = cls(arr.shape, arr.dtype)
+        shared_arr.array[...] = arr
+        return shared_arr
+
+    def __reduce__(self):
+        return (SharedArray, (self.shape, self.dtype.str, self.name))
+
+    def release(self):
+        """
+        Unmap the buffer (views of .array must be gone) and unlink the segment if owned
+        """
+        if self.shm is None:
+            return
+        self.array = None
+        try:
+            self.shm.close()
+        except BufferError:
+            pass # views of the array are still alive, the mapping goes away with them
+        if self.owner:
+            SHARED_ARRAY_NAMES_CREATED.discard(self.name)
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+        self.shm = None
+
+    def __del__(self):
+        self.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def __repr__(self):
+        return f"SharedArray({self.name}, {self.shape}, {self.dtype}, owner={self.owner})"
+
+def iter_shared_arrays(obj):
+    """
+    Find the SharedArrays of a task result, also inside tuples, lists and dict values
+    """
+    if isinstance(obj, SharedArray):
+        yield obj
+    elif isinstance(obj, (tuple, list)):
+        for value in obj:
+            yield from iter_shared_arrays(value)
+    elif isinstance(obj, dict):
+        for value in obj.values():
+            yield from iter_shared_arrays(value)
+
+def release_shared_arrays(obj):
+    """
+    Take ownership of the SharedArrays of a task result and release them
+    """
+    for shared_arr in iter_shared_arrays(obj):
+        shared_arr.owner = True
+        shared_arr.release()
+
+def unlink_created_shared_arrays():
+    for name in list(SHARED_ARRAY_NAMES_CREATED):
+        try:
+            shm = shared_memory.SharedMemory(name=name)
+            shm.close()
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+    SHARED_ARRAY_NAMES_CREATED.clear()
+
+def handle_worker_sigterm(signum, frame):
+    """
+    Unlink the shared arrays of the current task before the worker dies, e.g. when killed by the parent watchdog
+    """
+    unlink_created_shared_arrays()
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    os.kill(os.getpid(), signal.SIGTERM)
+
+def init_worker(ppid, initializer=None, initargs=()):
+    """
+    Initialize a pool worker: start the parent watchdog, then run the user initializer once
+    """
+    signal.signal(signal.SIGTERM, handle_worker_sigterm)
+    start_thread_to_terminate_when_parent_process_dies(ppid)
+    if initializer is not None:
+        initializer(*initargs)
+
+##################### Fault tolerance
+# A task can have a timeout (SIGALRM in the worker, so a hung FTP / HTTP call raises TaskTimeoutError),
+# is retried with exponential backoff, and with capture_errors its last exception becomes a TaskError
+# result instead of aborting the whole job. Completed item keys can be appended to a TaskCheckpoint file,
+# so a rerun skips the items that already finished.
+
+class TaskTimeoutError(TimeoutError):
+    pass
+
+class TaskError(BaseModel):
+    """
+    Result of a task whose last attempt raised
+    """
+    item: str=""
+    error_type: str=""
+    error: str=""
+    traceback: str=""
+    attempts: int=0
+
+def raise_task_timeout(signum, frame):
+    raise TaskTimeoutError("Task timed out")
+
+def run_task(workfn, item, kwargs: dict, timeout: float=None, retries: int=0, retry_backoff: float=1.0, capture_errors: bool=False):
+    """
+    Run workfn on one item with a timeout (seconds, main thread only) and retries after retry_backoff * 2^attempt seconds
+    """
+    use_alarm = timeout is not None and threading.current_thread() is threading.main_thread()
+    for attempt in range(retries + 1):
+        try:
+            if use_alarm:
+                signal.signal(signal.SIGALRM, raise_task_timeout)
+                signal.setitimer(signal.ITIMER_REAL, timeout)
+            try:
+                return workfn(item, **kwargs)
+            finally:
+                if use_alarm:
+                    signal.setitimer(signal.ITIMER_REAL, 0)
+        except Exception as e:
+            if attempt < retries:
+                logger.warning(f"Task {str(item)[:200]} failed ({type(e).__name__}: {e}), retry {attempt + 1}/{retries}")
+                time.sleep(retry_backoff * 2 ** attempt)
+                continue
+            if not capture_errors:
+                raise
+            return TaskError(item=str(item)[:1000], error_type=type(e).__name__, error=str(e), traceback=traceback.format_exc(), attempts=attempt + 1)
+
+def run_chunk(workfn, chunk, kwargs: dict, **task_options):
+    """
+    Run workfn on a chunk of items in one task, so the per-task IPC is paid once per chunk.
+    SharedArrays of the results are handed over to the parent, which unlinks them.
+    """
+    SHARED_ARRAY_NAMES_CREATED.clear() # the results of the previous task are owned by the parent now
+    results = [run_task(workfn, item, kwargs, **task_options) for item in chunk]
+    for shared_arr in iter_shared_arrays(results):
+        shared_arr.owner = False
+    return results
+
+class TaskCheckpoint:
+    """
+    Append-only file of the keys of completed items, one per line. Without resume the file is started over.
+    """
+    def __init__(self, path, resume: bool=True):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.keys = set()
+        if resume and self.path.exists():
+            with open(self.path, "r") as f:
+                self.keys = set(line.rstrip("\n") for line in f if line.strip() != "")
+        self.file = open(self.path, "a" if resume else "w")
+
+    def __contains__(self, key):
+        return str(key) in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key):
+        key = str(key)
+        if "\n" in key:
+            raise ValueError(f"Checkpoint key {key!r} contains a new line")
+        if key not in self.keys:
+            self.keys.add(key)
+            self.file.write(key + "\n")
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+def iter_chunks(items, chunksize):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == chunksize:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+def start_work_ppe(workfn, items, num_workers=8, show_tqdm=False, chunksize=1, initializer=None, initargs=(), **kwargs):
+    PPE = SafePPE(num_workers=num_workers, initializer=initializer, initargs=initargs)
+    res = PPE.do_work(workfn, items,show_tqdm=show_tqdm, chunksize=chunksize, **kwargs)
     PPE.shutdown(wait=False)
     return res
 
+def iter_work_ppe(
+    workfn, items, num_workers=8, show_tqdm=False, max_in_flight=None, ordered=False, chunksize=1, initializer=None, initargs=(),
+    timeout=None, retries=0, retry_backoff=1.0, capture_errors=False, checkpoint=None, item_key=str, **kwargs,
+):
+    """
+    Streaming start_work_ppe, yield (index, result) as the items finish, see SafePPE.iter_work
+    """
+    PPE = SafePPE(num_workers=num_workers, initializer=initializer, initargs=initargs)
+    try:
+        yield from PPE.iter_work(
+            workfn, items, show_tqdm=show_tqdm, max_in_flight=max_in_flight, ordered=ordered, chunksize=chunksize,
+            timeout=timeout, retries=retries, retry_backoff=retry_backoff, capture_errors=capture_errors,
+            checkpoint=checkpoint, item_key=item_key, **kwargs,
+        )
+    finally:
+        PPE.shutdown(wait=False, cancel_futures=True)
+
 class SafePPE:
-    def __init__(self, num_workers=8):
+    def __init__(self, num_workers=8, initializer=None, initargs=()):
+        """
+        initializer(*initargs) runs once in every worker, e.g. to keep per-process resources with set_worker_state
+        """
         self.num_workers = num_workers
+        # the workers must share the resource tracker of the parent, which owns their SharedArrays in the end
+        resource_tracker.ensure_running()
         self.executor = ProcessPoolExecutor(max_workers=num_workers, 
-                             initializer=start_thread_to_terminate_when_parent_process_dies, 
-                             initargs=(os.getpid(),))
+                             initializer=init_worker, 
+                             initargs=(os.getpid(), initializer, initargs))
         # print("Started PPE")
         sys.stdout.flush()
     def shutdown(self, wait=True, cancel_futures=False):
         self.executor.shutdown(wait=wait, cancel_futures=cancel_futures)
-    def do_work(self, workfn, items, show_tqdm=False, **kwargs):
-        futures = []
+    def do_work(self, workfn, items, show_tqdm=False, chunksize=1, **kwargs):
+        """
+        Run workfn on all items and return the results in input order, see iter_work for the options
+        (items skipped by a checkpoint are left out)
+        """
+        return [result for _, result in self.iter_work(workfn, items, show_tqdm=show_tqdm, ordered=True, chunksize=chunksize, **kwargs)]
+    def iter_work(
+        self, workfn, items, show_tqdm=False, max_in_flight=None, ordered=False, total=None, chunksize=1,
+        timeout=None, retries=0, retry_backoff=1.0, capture_errors=False, checkpoint: TaskCheckpoint=None, item_key=str, **kwargs,
+    ):
+        """
+        Stream items (any iterable, e.g. a generator) through the pool and yield (index, result) as the tasks finish,
+        or in input order if ordered. At most max_in_flight (default 4 x num_workers) tasks are submitted and not yet
+        yielded, so the pending futures and pickled arguments stay bounded for any number of items.
+        With chunksize > 1 each task runs workfn on chunksize items, for small work functions.
+        SharedArrays returned by workfn are owned by the caller, release them when done.
+
+        Each item gets timeout seconds and retries extra attempts, with capture_errors a failed item yields a TaskError
+        instead of raising. With a checkpoint, items whose item_key(item) is in it are skipped (not yielded)
+        and the keys of the items that did not fail are added to it.
+        """
+        if max_in_flight is None:
+            max_in_flight = self.num_workers * 4
+        if total is None and hasattr(items, "__len__"):
+            total = len(items)
         if show_tqdm:
-            tqdm_bar = tqdm(total=len(items))
-        for item in items:
-            futures.append(self.executor.submit(workfn, item, **kwargs))
-        res = []
-        for future in futures:
-            res.append(future.result())
+            tqdm_bar = tqdm(total=total)
+        task_options = dict(timeout=timeout, retries=retries, retry_backoff=retry_backoff, capture_errors=capture_errors)
+
+        def iter_todo_items():
+            for index, item in enumerate(items):
+                if checkpoint is not None and item_key(item) in checkpoint:
+                    if show_tqdm:
+                        tqdm_bar.update(1)
+                    continue
+                yield index, item
+
+        chunks = enumerate(iter_chunks(iter_todo_items(), chunksize))
+        pending = {} # future -> (chunk index, [(item index, item)])
+        finished = {} # chunk index -> [(item index, result)], finished but waiting for an earlier chunk if ordered
+        next_chunk_index = 0
+        def submit_next():
+            for chunk_index, chunk in chunks:
+                future = self.executor.submit(run_chunk, workfn, [item for _, item in chunk], kwargs, **task_options)
+                pending[future] = (chunk_index, chunk)
+                return True
+            return False
+        try:
+            while len(pending) + len(finished) < max_in_flight and submit_next():
+                pass
+            while len(pending) > 0:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    chunk_index, chunk = pending.pop(future)
+                    results = future.result()
+                    for shared_arr in iter_shared_arrays(results):
+                        shared_arr.owner = True
+                    if checkpoint is not None:
+                        for (_, item), result in zip(chunk, results):
+                            if not isinstance(result, TaskError):
+                                checkpoint.add(item_key(item))
+                    if show_tqdm:
+                        tqdm_bar.update(len(results))
+                    indexed_results = [(index, result) for (index, _), result in zip(chunk, results)]
+                    if not ordered:
+                        yield from indexed_results
+                        continue
+                    finished[chunk_index] = indexed_results
+                    while next_chunk_index in finished:
+                        yield from finished.pop(next_chunk_index)
+                        next_chunk_index += 1
+                while len(pending) + len(finished) < max_in_flight and submit_next():
+                    pass
+        finally:
+            # stopped early: the results never yielded are released here, nobody else owns their SharedArrays
+            for future in pending:
+                future.cancel()
+            for future in pending:
+                if future.done() and not future.cancelled() and future.exception() is None:
+                    release_shared_arrays(future.result())
+            for indexed_results in finished.values():
+                release_shared_arrays([result for _, result in indexed_results])
             if show_tqdm:
-                tqdm_bar.update(1)
-        if show_tqdm:
-            tqdm_bar.close()
-        return res
-        
\ No newline at end of file
+                tqdm_bar.close()
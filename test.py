@@ -27,6 +27,7 @@ def pipeline_empiar_data_curation():
     # Step2: get empiar path csv
     save_empiar_path_csvs()
     empiar_path_csv = load_empiar_path_csv(empiar_ids[0])
+    save_empiar_path_catalog()
     
     # Step3: get empiar emdb json entries
     save_empiar_emdb_entries()
@@ -35,12 +36,8 @@ def pipeline_empiar_data_curation():
 
 def mongodb_dataset_generation():
     print("================================================")
-    # Movie Dataset + Micrograph Dataset
-    generate_empiar_dataset_documents(num_workers=8, image_max_num=1000)
-    # Micrograph Dataset
-    generate_micrograph_dataset_documents(num_workers=8, image_max_num=1000)
-    # Movie Dataset
-    generate_movie_dataset_documents(num_workers=8, image_max_num=1000)
+    # EMPIAR Dataset + Micrograph Dataset + Movie Dataset, each EMPIAR entry parsed once
+    generate_dataset_documents(num_workers=8, image_max_num=1000)
     print("================================================\n\n")
 
 def mongodb_dataset_have_a_look():
@@ -99,10 +96,48 @@ def cryosparc_data_process():
     unset_dataset_SingleImageTestStatus(micrograph_dataset, document)
     print("================================================\n\n")
     
+def micrograph_stack_check():
+    import numpy as np
+    from CryoCRAB.utils.micrograph import bin_mic, upsample_mic
+    print("================================================")
+    # a (Z, Y, X) stack, also with Z = 1, must give the same frames as the (Y, X) micrographs
+    rng = np.random.default_rng(0)
+    mic = (rng.normal(size=(500, 700)) * 20 + 100).astype(np.float32)
+    for Z in [1, 3]:
+        stack = np.stack([mic] * Z)
+        stack_bin, stack_up = bin_mic(stack, 2), upsample_mic(stack, 2)
+        assert stack_bin.shape == (Z, 250, 350) and stack_up.shape == (Z, 1000, 1400), f"{Z = } {stack_bin.shape = } {stack_up.shape = }"
+        assert np.allclose(stack_bin[-1], bin_mic(mic, 2)) and np.allclose(stack_up[-1], upsample_mic(mic, 2)), f"{Z = } stack frames differ"
+        print(f"{Z = } ok")
+    print("================================================\n\n")
+
+def micrograph_preprocess_check():
+    import numpy as np
+    from CryoCRAB.utils import fft_sizes
+    from CryoCRAB.utils.micrograph import preprocess_micrograph, estimate_subtract_background, bin_mic, trim_mic
+    print("================================================")
+    # the fused preprocessing must match estimate_subtract_background + bin_mic,
+    # also when the padded size is not bg_binfactor * N_bg (3296 -> 3360 / 4 is not a fast size)
+    for frame_shape, psize in [((3296, 3296), 1.06), ((3486, 4912), 0.8), ((4096, 4096), 1.0)]:
+        rng = np.random.default_rng(0)
+        y, x = np.mgrid[:frame_shape[0], :frame_shape[1]]
+        mic_gc = (rng.normal(size=frame_shape) + 5*np.sin(x/700.) + 3*np.cos(y/900.)).astype(np.float32)
+        N_in, N_out, _, _, _ = fft_sizes.get_shapes_for_desired_psize(psize, frame_shape, 3.0)
+        mic_fused, _ = preprocess_micrograph(mic_gc, psize)
+        mic_ref = bin_mic(estimate_subtract_background(mic_gc, psize), N_in / N_out)
+        shape = tuple(min(a, b) for a, b in zip(mic_fused.shape, mic_ref.shape))
+        mic_fused, mic_ref = trim_mic(mic_fused, shape), trim_mic(mic_ref, shape)
+        error = np.abs(mic_fused - mic_ref).max() / np.ptp(mic_ref)
+        print(f"{frame_shape = } {psize = } {error = :.2e}")
+        assert error < 1e-4, f"preprocess_micrograph differs from estimate_subtract_background + bin_mic on {frame_shape}"
+    print("================================================\n\n")
+
 def main():
     # pipeline_empiar_data_curation()
     # mongodb_dataset_generation()
     # mongodb_dataset_have_a_look()
+    # micrograph_stack_check()
+    # micrograph_preprocess_check()
     cryosparc_data_process()
     pass
     